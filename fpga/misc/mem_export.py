@@ -0,0 +1,261 @@
+#! /usr/bin/env python3
+
+# Bulk writer of memory initialization and test vector files: hex, mem, mif, coe and bin.
+#
+# As a command line tool, it takes the same options as create_mif.rb and creates the same
+# files, byte for byte, except that it refuses to write more words than the memory depth,
+# where create_mif.rb writes all words anyway. Like create_mif.rb, it doesn't wrap the words
+# to the width: with -w 12, a word shows all 16 bits of its two bytes. The firmware build in fpga/sw still uses
+# create_mif.rb.
+# It also replaces hex2bin.py and bin2hex.py:
+#
+#   mem_export.py -t hex -f bin -w 8 < in.hex > out.txt        (hex2bin.py)
+#   mem_export.py -t bin -f hex -w 8 < in.txt > out.hex        (bin2hex.py)
+#
+# As a library, write_mem() writes numpy arrays directly, e.g. PDM stimulus and expected PCM
+# samples from the modeling scripts (see write_vectors()).
+#
+# All lines of a file have the same length, so the text is created with numpy operations
+# on a 2D array of characters, one row per word, instead of one format string per word.
+# Files are written through a memory map, in chunks of chunk_size words.
+
+import sys
+import argparse
+
+import numpy as np
+
+HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype = np.uint8)
+
+chunk_size = 1 << 20
+
+def nr_hex_digits(width):
+    return ((width + 7) >> 3) * 2
+
+# ASCII digits of values, one row per value, most significant digit first.
+def digits(values, nr_digits, bits_per_digit = 4):
+
+    shifts = np.arange(nr_digits-1, -1, -1, dtype = np.uint64) * np.uint64(bits_per_digit)
+    d      = (values[:, None] >> shifts) & np.uint64((1 << bits_per_digit) - 1)
+
+    return HEX_DIGITS[d]
+
+# Returns (header, line_length, render, footer) for a file of the given format:
+# render(start, stop) returns the lines of words[start:stop] as a 2D uint8 array.
+def layout(words, width, format, depth):
+
+    nr_words    = len(words)
+    data_digits = nr_hex_digits(width)
+
+    def data_lines(start, stop, prefix = None, suffix = b"\n"):
+        parts = []
+        if prefix is not None:
+            parts.append(prefix(start, stop))
+        parts.append(digits(words[start:stop], data_digits))
+        parts.append(np.broadcast_to(np.frombuffer(suffix, dtype = np.uint8), (stop-start, len(suffix))))
+
+        return np.hstack(parts)
+
+    if format == "mif":
+        nr_addr_bits = int(np.ceil(np.log2(depth))) if depth > 1 else 0
+        addr_digits  = max((nr_addr_bits + 3) >> 2, 1)
+
+        header = ("-- Created by create_mif.rb\n"
+                  "DEPTH         = %d;\n"
+                  "WIDTH         = %d;\n"
+                  "ADDRESS_RADIX = HEX;\n"
+                  "DATA_RADIX    = HEX;\n"
+                  "CONTENT\n"
+                  "BEGIN\n"
+                  "    \n") % (depth, width)
+
+        def addresses(start, stop):
+            addr = np.arange(start, stop, dtype = np.uint64)
+            return np.hstack([ digits(addr, addr_digits), np.frombuffer(b": ", dtype = np.uint8)[None, :].repeat(stop-start, axis = 0) ])
+
+        footer = ""
+        if nr_words < depth:
+            fmt     = "[%%0%dx..%%0%dx]: %%0%dx;\n" % (addr_digits, addr_digits, data_digits)
+            footer += fmt % (nr_words, depth-1, 0)
+        footer += "END;\n\n"
+
+        render = lambda start, stop: data_lines(start, stop, prefix = addresses, suffix = b";\n")
+
+        return header.encode(), addr_digits + 2 + data_digits + 2, render, footer.encode()
+
+    if format == "coe":
+        header = ("; Created by create_mif.rb\n"
+                  "; block memory configuration:\n"
+                  "; DEPTH         = %d;\n"
+                  "; WIDTH         = %d;\n"
+                  "memory_initialization_radix=16;\n"
+                  "memory_initialization_vector=\n") % (depth, width)
+
+        def render(start, stop):
+            lines = data_lines(start, stop, suffix = b",\n")
+            if stop == nr_words and stop > start:
+                lines[-1, -2] = ord(";")
+            return lines
+
+        footer = b";\n" if nr_words == 0 else b""
+
+        return header.encode(), data_digits + 2, render, footer
+
+    if format in ("hex", "mem"):
+        header = "@00000000\n" if format == "mem" else ""
+        footer = b"\n" if nr_words == 0 else b""
+
+        return header.encode(), data_digits + 1, data_lines, footer
+
+    if format == "bin":
+        def render(start, stop):
+            return np.hstack([ digits(words[start:stop], width, bits_per_digit = 1),
+                               np.full((stop-start, 1), ord("\n"), dtype = np.uint8) ])
+
+        return b"", width + 1, render, b""
+
+    raise ValueError("Unknown format '%s'" % format)
+
+# Words as uint64, wrapped to width bits (negative values become their 2's complement) when
+# mask is set, and padded with zeros up to depth for the formats that fill the whole memory.
+def prepare_words(words, width, format, depth, mask = True):
+
+    assert width <= 64, "Words wider than 64 bits are not supported"
+
+    words = np.asarray(words)
+    if words.dtype != np.uint64:
+        words = words.astype(np.int64).astype(np.uint64)
+
+    if mask and width < 64:
+        words = words & np.uint64((1 << width) - 1)
+
+    if depth is None:
+        depth = len(words)
+
+    # create_mif.rb writes all words anyway, with addresses that don't fit in the address width.
+    if len(words) > depth:
+        raise ValueError("%d words don't fit in a memory with depth %d" % (len(words), depth))
+
+    if format in ("coe", "hex", "mem", "bin") and len(words) < depth:
+        words = np.concatenate([ words, np.zeros(depth - len(words), dtype = np.uint64) ])
+
+    return words, depth
+
+# Writes words (any integer numpy array) to filename, or to a binary stream like
+# sys.stdout.buffer.
+#
+# width:  word width in bits.
+# format: "hex", "mem", "mif", "coe" (as create_mif.rb) or "bin" (one binary number per line).
+# depth:  memory depth. Defaults to the number of words.
+# mask:   wrap the words to width bits. Without it, the hex formats show all the bits of
+#         the (width+7)/8 bytes of a word, like create_mif.rb does.
+def write_mem(filename, words, width, format = "hex", depth = None, mask = True):
+
+    (words, depth) = prepare_words(words, width, format, depth, mask)
+    (header, line_length, render, footer) = layout(words, width, format, depth)
+
+    nr_words = len(words)
+
+    if not isinstance(filename, str):
+        filename.write(header)
+        for start in range(0, nr_words, chunk_size):
+            filename.write(render(start, min(start + chunk_size, nr_words)).tobytes())
+        filename.write(footer)
+        return
+
+    size = len(header) + nr_words * line_length + len(footer)
+
+    if size == 0:
+        open(filename, "wb").close()
+        return
+
+    out = np.memmap(filename, dtype = np.uint8, mode = "w+", shape = (size,))
+
+    out[:len(header)] = np.frombuffer(header, dtype = np.uint8)
+
+    body = out[len(header):len(header) + nr_words * line_length].reshape(nr_words, line_length)
+    for start in range(0, nr_words, chunk_size):
+        stop = min(start + chunk_size, nr_words)
+        body[start:stop] = render(start, stop)
+
+    out[size-len(footer):] = np.frombuffer(footer, dtype = np.uint8)
+
+    out.flush()
+    del out
+
+# Writes the stimulus and expected result of a PDM to PCM simulation:
+# <prefix>_pdm.<format> and <prefix>_pcm.<format>.
+#
+# pdm_width PDM bits are packed per word: bit i of word k is PDM sample k*pdm_width + i.
+# PCM samples are written as pcm_width bit 2's complement numbers.
+def write_vectors(prefix, pdm, pcm, pcm_width, format = "hex", pdm_width = 1):
+
+    pdm = np.asarray(pdm).astype(np.uint64) & np.uint64(1)
+    pdm = np.concatenate([ pdm, np.zeros(-len(pdm) % pdm_width, dtype = np.uint64) ])
+
+    weights   = np.uint64(1) << np.arange(pdm_width, dtype = np.uint64)
+    pdm_words = (pdm.reshape(-1, pdm_width) * weights).sum(axis = 1, dtype = np.uint64)
+
+    write_mem("%s_pdm.%s" % (prefix, format), pdm_words, pdm_width, format)
+    write_mem("%s_pcm.%s" % (prefix, format), pcm, pcm_width, format)
+
+# Same word extraction as create_mif.rb: every increment-th byte, starting at offset,
+# combined little endian into words of (width+7)/8 bytes.
+def words_from_binary(data, width, offset = 0, increment = 1):
+
+    data           = np.frombuffer(data, dtype = np.uint8)[offset::increment].astype(np.uint64)
+    bytes_per_word = (width + 7) >> 3
+
+    data    = np.concatenate([ data, np.zeros(-len(data) % bytes_per_word, dtype = np.uint64) ])
+    weights = np.uint64(1) << (np.arange(bytes_per_word, dtype = np.uint64) * np.uint64(8))
+
+    return (data.reshape(-1, bytes_per_word) * weights).sum(axis = 1, dtype = np.uint64)
+
+def words_from_text(text, base):
+    return np.array([ int(line, base) for line in text.split() ], dtype = np.uint64)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Create memory initialization files")
+    parser.add_argument("-v", "--verbose",      action = "store_true", help = "Run verbosely")
+    parser.add_argument("-f", "--format",       default = "mif", help = "Output format ('mif', 'hex', 'coe', 'mem', 'bin')")
+    parser.add_argument("-d", "--depth",        type = int, help = "Memory depth")
+    parser.add_argument("-w", "--width",        type = int, default = 8, help = "Memory width (bits)")
+    parser.add_argument("-o", "--offset",       type = int, default = 0, help = "First byte to use of the binary input file (default = 0)")
+    parser.add_argument("-i", "--increment",    type = int, default = 1, help = "How many bytes to the next byte (default = 1)")
+    parser.add_argument("-t", "--input-format", default = "binary", help = "Input format: 'binary' file, or text with one 'hex' or 'bin' number per line")
+    parser.add_argument("--output",             help = "Output file (default: stdout)")
+    parser.add_argument("input",                nargs = "?", default = "-", help = "Input file (default: stdin)")
+
+    args = parser.parse_args()
+
+    if args.input == "-":
+        data = sys.stdin.buffer.read()
+    else:
+        data = open(args.input, "rb").read()
+
+    if args.input_format == "binary":
+        words = words_from_binary(data, args.width, args.offset, args.increment)
+    elif args.input_format == "hex":
+        words = words_from_text(data.decode(), 16)
+    elif args.input_format == "bin":
+        words = words_from_text(data.decode(), 2)
+    else:
+        sys.exit("Unknown input format '%s'! Aborting..." % args.input_format)
+
+    depth = args.depth
+    if depth is None:
+        # create_mif.rb counts bytes, not words, for the default depth.
+        depth = len(np.frombuffer(data, dtype = np.uint8)[args.offset::args.increment]) if args.input_format == "binary" else len(words)
+
+    if args.verbose:
+        sys.stderr.write("output format : %s\n" % args.format)
+        sys.stderr.write("depth         : %d\n" % depth)
+        sys.stderr.write("width         : %d\n" % args.width)
+        sys.stderr.write("bytes per word: %d\n" % ((args.width + 7) >> 3))
+        sys.stderr.write("start offset  : %d\n" % args.offset)
+        sys.stderr.write("increment     : %d\n" % args.increment)
+
+    try:
+        write_mem(args.output or sys.stdout.buffer, words, args.width, args.format, depth, mask = False)
+    except ValueError as e:
+        sys.exit("%s! Aborting..." % e)
@@ -18,12 +18,7 @@ else:
 def mov_avg_filter_psd(length = 64, order = 1, osr = None, plotStop = None, plotPass = None, plotLog = True):
 
     N = 8192
-    h_orig = np.full(length, 1/length)
-
-    h = h_orig
-
-    for i in range(order-1):
-        h = np.convolve(h, h_orig)
+    h = cic_filter(length, order)
 
     h_padded = np.zeros(N)
     h_padded[0:len(h)] = h
@@ -219,12 +214,9 @@ if True:
     decimation = 4
     order = 5
 
-    h_mov_avg = np.ones(decimation) / decimation
-    h_mov_avg_casc = h_mov_avg
-    for i in range(order-1):
-        h_mov_avg_casc = np.convolve(h_mov_avg_casc, h_mov_avg)
+    h_mov_avg_casc = cic_filter(decimation, order)
 
-        h_mov_avg_casc_stats = FilterStats(h_mov_avg_casc, fsample = f_sample, fcutoff = f_cutoff, fstop = f_cutoff*1.2, N = 16384)
+    h_mov_avg_casc_stats = FilterStats(h_mov_avg_casc, fsample = f_sample, fcutoff = f_cutoff, fstop = f_cutoff*1.2, N = 16384)
 
     plt.figure(figsize=(10,4))
     plt.subplot(111)
@@ -203,3 +203,73 @@ class FilterStats:
         plt.tight_layout()
         plt.savefig(filename)
 
+# decimation:
+# This determines the number of samples that are averaged together thus
+# frequency behavior in terms of where the attenuation becomes infinite etc.
+#
+# order:
+# the number of cascaded CIC filter sections.
+#
+# differential_delay:
+# the number of delays in the integrator part of the CIC cascade.
+# The differential delay is almost always 1, or sometimes 2.
+
+# The impulse response of an order N CIC filter consists of the integer coefficients of the
+# polynomial ((1-z^-RM)/(1-z^-1))^N.
+#
+# Order N is calculated from order N-1 by multiplying with (1-z^-RM) and dividing by (1-z^-1),
+# which is a running sum. That's O(length) per order instead of the O(length * RM) of a
+# convolution, and it's exact.
+#
+# All orders that were ever calculated for a (decimation, differential_delay) pair are kept in
+# cic_integer_taps_cache, so a sweep over orders only calculates each order once.
+#
+# Coefficients are int64 as long as their sum (RM)^N fits, Python integers otherwise.
+cic_integer_taps_cache = {}
+
+def cic_integer_taps_upto(decimation, max_order, differential_delay = 1):
+
+    L = decimation * differential_delay
+
+    taps = cic_integer_taps_cache.setdefault((decimation, differential_delay), [ np.ones(1, dtype = np.int64) ])
+
+    while len(taps) <= max_order:
+        order   = len(taps)
+        prev    = taps[-1]
+
+        if L**order < 2**63:
+            c = np.zeros(len(prev) + L, dtype = np.int64)
+        else:
+            c = np.zeros(len(prev) + L, dtype = object)
+            prev = prev.astype(object)
+
+        c[:len(prev)]   += prev
+        c[L:]           -= prev
+        c = np.cumsum(c)[:len(prev) + L - 1]
+
+        c.setflags(write = False)
+        taps.append(c)
+
+    return taps[1:max_order+1]
+
+def cic_integer_taps(decimation, order, differential_delay = 1):
+    return cic_integer_taps_upto(decimation, order, differential_delay)[order-1]
+
+# normalize:
+# return the impulse response scaled to a DC gain of 1 as float64, instead of the integer
+# coefficients.
+def cic_filter(decimation, order, differential_delay = 1, normalize = True):
+
+        h_cic = cic_integer_taps(decimation, order, differential_delay)
+
+        if not normalize:
+            return h_cic
+
+        gain = (decimation * differential_delay)**order
+
+        # Beyond 2^53, int64 coefficients can't be converted to float64 exactly before the
+        # division. Python integers divide with a correctly rounded result.
+        if gain >= 2**53:
+            h_cic = h_cic.astype(object)
+
+        return (h_cic / gain).astype(np.float64)
@@ -38,7 +38,7 @@ if plot_filter_the_damn_thing:
     print("Filter the Damn Thing: f_pdm -> final = %d" % f_pdm)
     print()
 
-    N = fir_find_optimal_N(f_pdm, f_pb, f_sb, a_pb, a_sb, Nmin = 2205, Nmax = 2500)
+    N = fir_find_optimal_N(f_pdm, f_pb, f_sb, a_pb, a_sb, Nmax = 5000)
     print("Filter order: %d" % N)
     (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = fir_calc_filter(f_pdm, f_pb, f_sb, a_pb, a_sb, N)
 
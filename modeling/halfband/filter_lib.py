@@ -1,6 +1,13 @@
 
+import os
+import glob
+import hashlib
+import tempfile
+import collections
+
 import numpy as np
 from matplotlib import pyplot as plt
+import scipy
 from scipy import signal
 
 def dB20(array):
@@ -8,8 +15,152 @@ def dB20(array):
         return 20 * np.log10(array)
 
 
+# Two-tier cache for filter designs that are pure functions of their spec.
+#
+# Tier 1 is an in-process LRU of at most max_entries designs.
+# Tier 2 is a directory of .npz files, one per design, named after a hash of the
+# normalized spec and the scipy version that produced it. When the directory grows
+# beyond max_bytes, the least recently used files are deleted.
+#
+# Designs are tuples of numpy arrays and scalars. The arrays that are handed out
+# are read-only, because the same objects are returned to every caller.
+#
+# Set FILTER_CACHE_DIR in the environment to move the disk cache, or to an empty
+# string to disable it.
+class FilterDesignCache:
+
+    def __init__(self, cache_dir, max_entries = 256, max_bytes = 256 * 1024**2):
+
+        self.cache_dir      = cache_dir
+        self.max_entries    = max_entries
+        self.max_bytes      = max_bytes
+
+        self.memory         = collections.OrderedDict()
+        self.disk_bytes     = None
+
+    def key_hash(self, spec):
+        # Callers pass frequencies normalized to Fs. Rounding them to 12 significant digits
+        # makes specs that only differ in floating point noise map to the same design.
+        spec_str = repr(tuple(("%.12g" % s) if isinstance(s, float) else s for s in spec))
+        spec_str += " scipy=" + scipy.__version__
+
+        return hashlib.sha1(spec_str.encode()).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def lookup(self, spec):
+        key = self.key_hash(spec)
+
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        if not self.cache_dir:
+            return None
+
+        try:
+            with np.load(self.filename(key)) as npz:
+                design = tuple(npz["arr_%d" % i][()] for i in range(len(npz.files)))
+            os.utime(self.filename(key))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return self.remember(key, design)
+
+    def store(self, spec, design):
+        key = self.key_hash(spec)
+
+        design = self.remember(key, design)
+
+        if not self.cache_dir:
+            return design
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok = True)
+
+            # Write to a temporary file and rename, so that concurrent processes never
+            # see a partially written design.
+            (fd, tmp_filename) = tempfile.mkstemp(dir = self.cache_dir, suffix = ".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, *design)
+            os.replace(tmp_filename, self.filename(key))
+        except OSError:
+            return design
+
+        try:
+            self.evict(os.path.getsize(self.filename(key)))
+        except OSError:
+            # Another process may be evicting from the same directory.
+            self.disk_bytes = None
+
+        return design
+
+    def remember(self, key, design):
+        design = tuple(np.array(d) if isinstance(d, np.ndarray) else d for d in design)
+        for d in design:
+            if isinstance(d, np.ndarray):
+                d.setflags(write = False)
+
+        self.memory[key] = design
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last = False)
+
+        return design
+
+    def evict(self, added_bytes):
+        if self.disk_bytes is None:
+            self.disk_bytes = sum(os.path.getsize(f) for f in glob.glob(os.path.join(self.cache_dir, "*.npz")))
+        else:
+            self.disk_bytes += added_bytes
+
+        if self.disk_bytes <= self.max_bytes:
+            return
+
+        files = sorted(glob.glob(os.path.join(self.cache_dir, "*.npz")), key = os.path.getmtime)
+        self.disk_bytes = sum(os.path.getsize(f) for f in files)
+
+        for f in files:
+            if self.disk_bytes <= self.max_bytes:
+                break
+            try:
+                self.disk_bytes -= os.path.getsize(f)
+                os.remove(f)
+            except OSError:
+                pass
+
+    def clear(self, disk = False):
+        self.memory.clear()
+
+        if disk and self.cache_dir:
+            for f in glob.glob(os.path.join(self.cache_dir, "*.npz")):
+                os.remove(f)
+            self.disk_bytes = 0
+
+filter_design_cache = FilterDesignCache(
+        os.environ.get("FILTER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pdm_filter_designs"))
+        )
+
 def fir_calc_filter(Fs, Fpb, Fsb, Apb, Asb, N):
 
+    spec = ("fir", Fpb/Fs, Fsb/Fs, float(Apb), float(Asb), int(N))
+
+    design = filter_design_cache.lookup(spec)
+    if design is None:
+        design = filter_design_cache.store(spec, fir_design_filter(Fs, Fpb, Fsb, Apb, Asb, N))
+
+    (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = design
+
+    print("Rpb: %fdB" % (-dB20(Rpb)))
+    print("Rsb: %fdB" % -dB20(Rsb))
+
+    return (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max)
+
+# The uncached part of fir_calc_filter.
+def fir_design_filter(Fs, Fpb, Fsb, Apb, Asb, N):
+
     bands = np.array([0., Fpb/Fs, Fsb/Fs, .5])
 
     # Remez weight calculation:
@@ -37,19 +188,116 @@ def fir_calc_filter(Fs, Fpb, Fsb, Apb, Asb, N):
     Hsb_max = max(np.abs(H[int(Fsb/Fs*2 * len(H)+1):len(H)]))
     Rsb = Hsb_max
     
-    print("Rpb: %fdB" % (-dB20(Rpb)))
-    print("Rsb: %fdB" % -dB20(Rsb))
-
     return (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max)
 
-def fir_find_optimal_N(Fs, Fpb, Fsb, Apb, Asb, Nmin = 1, Nmax = 1000):
-    for N in range(Nmin, Nmax):
+# Analytic estimate of the order of an equiripple low-pass filter.
+#
+# The pass band and stop band ripple are derived the same way as the Remez
+# weights in fir_calc_filter, so the estimate tracks what remez will actually
+# be asked to do.
+#
+# method:
+#   "kaiser"    : N = (-20*log10(sqrt(dp*ds)) - 13) / (14.6 * df)
+#   "bellanger" : N = 2/3 * log10(1/(10*dp*ds)) / df
+#   "herrmann"  : Herrmann, Rabiner, Chan, "Practical Design Rules for Optimum
+#                 Finite Impulse Response Low-Pass Digital Filters" (1973).
+#                 Usually the most accurate of the three.
+def fir_estimate_N(Fs, Fpb, Fsb, Apb, Asb, method = "herrmann"):
+
+    dp = (1 - 10**(-Apb/20))/2
+    ds = 10**(-Asb/20)
+    df = (Fsb - Fpb)/Fs
+
+    if method == "kaiser":
+        N = (-20*np.log10(np.sqrt(dp*ds)) - 13) / (14.6 * df)
+    elif method == "bellanger":
+        N = 2/3 * np.log10(1/(10*dp*ds)) / df
+    elif method == "herrmann":
+        L1 = np.log10(dp)
+        L2 = np.log10(ds)
+
+        D_inf = (0.005309 * L1**2 + 0.07114 * L1 - 0.4761) * L2 - (0.00266 * L1**2 + 0.5941 * L1 + 0.4278)
+        f     = 11.01217 + 0.51244 * (L1 - L2)
+
+        N = D_inf/df - f*df
+    else:
+        assert False, "Unknown order estimation method '%s'" % method
+
+    return max(int(np.ceil(N)), 1)
+
+# Find the smallest order in the lattice Nmin, Nmin+step, ... (Nmax exclusive) for
+# which passes(N) is True, assuming that passes() is monotonic in N.
+#
+# The search starts at N_start (typically an analytic estimate), gallops with
+# doubling steps in the direction of the pass/fail boundary until it is bracketed,
+# and then bisects the bracket. This takes O(log(|N_start-N_opt|)) calls to passes()
+# instead of O(N_opt-Nmin) for a linear scan.
+def order_search(passes, N_start, Nmin, Nmax, step = 1):
+
+    nr_steps = (Nmax - Nmin + step - 1) // step
+    if nr_steps <= 0:
+        return None
+
+    k_start = min(max((N_start - Nmin + step - 1) // step, 0), nr_steps-1)
+
+    # Lattice indices of the highest known failing and lowest known passing order.
+    k_fail  = -1
+    k_pass  = None
+
+    if passes(Nmin + k_start * step):
+        k_pass  = k_start
+        gallop  = 1
+        while k_pass > 0:
+            k = max(k_pass - gallop, 0)
+            if passes(Nmin + k * step):
+                k_pass = k
+                gallop *= 2
+            else:
+                k_fail = k
+                break
+    else:
+        k_fail  = k_start
+        gallop  = 1
+        while k_pass is None:
+            k = min(k_fail + gallop, nr_steps-1)
+            if k == k_fail:
+                return None
+            if passes(Nmin + k * step):
+                k_pass = k
+            else:
+                k_fail = k
+                gallop *= 2
+
+    while k_pass - k_fail > 1:
+        k = (k_fail + k_pass) // 2
+        if passes(Nmin + k * step):
+            k_pass = k
+        else:
+            k_fail = k
+
+    return Nmin + k_pass * step
+
+# search:
+#   "bisect" : start from fir_estimate_N, gallop to a passing order and bisect
+#              down to the minimum. Roughly a dozen remez runs.
+#   "linear" : try every order from Nmin upwards.
+def fir_find_optimal_N(Fs, Fpb, Fsb, Apb, Asb, Nmin = 1, Nmax = 1000, search = "bisect"):
+
+    def passes(N):
         print("Trying N=%d" % N)
         (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = fir_calc_filter(Fs, Fpb, Fsb, Apb, Asb, N)
-        if -dB20(Rpb) <= Apb and -dB20(Rsb) >= Asb:
-            return N
+        return -dB20(Rpb) <= Apb and -dB20(Rsb) >= Asb
+
+    if search == "linear":
+        for N in range(Nmin, Nmax):
+            if passes(N):
+                return N
+
+        return None
+
+    N_est = fir_estimate_N(Fs, Fpb, Fsb, Apb, Asb)
 
-    return None
+    return order_search(passes, N_est, Nmin, Nmax)
 
 # Fs : sample frequency
 # Fpb: pass-band frequency. 
@@ -68,6 +316,22 @@ def half_band_calc_filter(Fs, Fpb, N):
     assert N % 2 == 0, "Filter order N must be a multiple of 2"
     assert N % 4 != 0, "Filter order N must not be a multiple of 4"
 
+    spec = ("half_band", Fpb/Fs, int(N))
+
+    design = filter_design_cache.lookup(spec)
+    if design is None:
+        design = filter_design_cache.store(spec, half_band_design_filter(Fs, Fpb, N))
+
+    (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = design
+
+    print("Rpb: %fdB" % (-dB20(Rpb)))
+    print("Rsb: %fdB" % -dB20(Rsb))
+
+    return (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max)
+
+# The uncached part of half_band_calc_filter.
+def half_band_design_filter(Fs, Fpb, N):
+
     g = signal.remez(
             N//2+1,
             [0., 2*Fpb/Fs, .5, .5],
@@ -92,19 +356,53 @@ def half_band_calc_filter(Fs, Fpb, N):
     Hsb_max = max(np.abs(H[int(Fsb/Fs*2 * len(H)+1):len(H)]))
     Rsb = Hsb_max
     
-    print("Rpb: %fdB" % (-dB20(Rpb)))
-    print("Rsb: %fdB" % -dB20(Rsb))
-
     return (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max)
 
-def half_band_find_optimal_N(Fs, Fpb, Apb, Asb, Nmin = 2, Nmax = 1000):
-    for N in range(Nmin, Nmax, 4):
+# A half-band filter has the same ripple in the pass band and the stop band, so
+# the order is determined by whichever of the two specs is the tightest.
+def half_band_estimate_N(Fs, Fpb, Apb, Asb, method = "herrmann"):
+
+    delta = min((1 - 10**(-Apb/20))/2, 10**(-Asb/20))
+
+    Apb_eq = -dB20(1 - 2*delta)
+    Asb_eq = -dB20(delta)
+
+    return fir_estimate_N(Fs, Fpb, Fs/2-Fpb, Apb_eq, Asb_eq, method = method)
+
+# Only orders with N % 4 == 2 are considered, starting from Nmin.
+#
+# search:
+#   "bisect" : start from half_band_estimate_N, gallop to a passing order and bisect
+#              down to the minimum.
+#   "linear" : try every valid order from Nmin upwards.
+#
+# Returns the order together with the filter that was designed for it:
+# (N, h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max)
+def half_band_find_optimal_N(Fs, Fpb, Apb, Asb, Nmin = 2, Nmax = 1000, search = "bisect"):
+    assert Nmin % 4 == 2, "Nmin must be a multiple of 2, but not a multiple of 4"
+
+    filters = {}
+
+    def passes(N):
         print("Trying N=%d" % N)
-        (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = half_band_calc_filter(Fs, Fpb, N)
-        if -dB20(Rpb) <= Apb and -dB20(Rsb) >= Asb:
-            return N
+        filters[N] = half_band_calc_filter(Fs, Fpb, N)
+        (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = filters[N]
+        return -dB20(Rpb) <= Apb and -dB20(Rsb) >= Asb
+
+    if search == "linear":
+        N = None
+        for N_try in range(Nmin, Nmax, 4):
+            if passes(N_try):
+                N = N_try
+                break
+    else:
+        N_est = half_band_estimate_N(Fs, Fpb, Apb, Asb)
+        N = order_search(passes, N_est, Nmin, Nmax, step = 4)
+
+    if N is None:
+        return None
 
-    return None
+    return (N,) + filters[N]
 
 def plot_freq_response(w, H, Fs, Fpb, Fsb, Hpb_min, Hpb_max, Hsb_max):
     plt.title("Frequency Reponse")
@@ -33,9 +33,7 @@ if plot_half_band_example:
     f_s     = 192
     f_pb    = 45.0
 
-    N = half_band_find_optimal_N(f_s, f_pb, 2, 10)
-
-    (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = half_band_calc_filter(f_s, f_pb, N)
+    (N, h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = half_band_find_optimal_N(f_s, f_pb, 2, 10)
 
     plt.figure(figsize=(10,8))
 
@@ -93,8 +91,7 @@ if plot_2stage_decimation:
     a_pb    = 0.1
     a_sb    = 90
 
-    hb_N = half_band_find_optimal_N(f_s, f_sb, a_pb/2, a_sb)
-    (hb_h, hb_w, hb_H, hb_Rpb, hb_Rsb, hb_Hpb_min, hb_Hpb_max, hb_Hsb_max) = half_band_calc_filter(f_s, f_sb, hb_N)
+    (hb_N, hb_h, hb_w, hb_H, hb_Rpb, hb_Rsb, hb_Hpb_min, hb_Hpb_max, hb_Hsb_max) = half_band_find_optimal_N(f_s, f_sb, a_pb/2, a_sb)
     hb_muls = f_s/2 * (hb_N/2+1)
 
     print(dB20(hb_Rpb))
@@ -0,0 +1,434 @@
+
+import numpy as np
+
+from filter_lib import cic_integer_taps
+
+# Streaming implementations of the decimation filters that are designed in filter_lib.
+#
+# All decimators keep their state between calls to process(), so a recording can be fed
+# in chunks of any size, and the concatenated output is identical to processing the whole
+# recording at once.
+
+# Cascaded Integrator-Comb decimator with lossless modular integer arithmetic.
+#
+# decimation:
+#   decimation ratio R
+# order:
+#   the number of cascaded integrator and comb sections N
+# differential_delay:
+#   the number of delays M in each comb section
+# nr_bits:
+#   register width. Intermediate results wrap around modulo 2^nr_bits, like in hardware.
+#   The default is the minimum width that makes the output exact:
+#   input_bits + ceil(N * log2(R*M)). This must not be larger than 64.
+# input_bits:
+#   width of the input samples. The default is 1 for PDM data (0/1) and 2 when signed is
+#   set, for PDM data that has been mapped to -1/+1: +1 is a 2 bit 2's complement number,
+#   and an all +1 input reaches +(R*M)^N at the output.
+# signed:
+#   interpret the input and the output as 2's complement numbers. Required when the input is
+#   signed, e.g. PDM data that has been mapped to -1/+1.
+#
+# The integrators run on np.cumsum of uint64 values, which wraps modulo 2^64. Since 2^nr_bits
+# divides 2^64, masking the comb output to nr_bits at the end gives the same result as
+# wrapping every register to nr_bits.
+#
+# An output sample is produced for every R-th input sample, starting with input sample R-1.
+# The gain of the filter is (R*M)^N.
+class CicDecimator:
+
+    def __init__(self, decimation, order, differential_delay = 1, nr_bits = None, input_bits = None, signed = False):
+
+        if input_bits is None:
+            input_bits = 2 if signed else 1
+
+        assert not signed or input_bits >= 2, "Signed input needs at least 2 bits: +1 doesn't fit in 1 bit"
+
+        self.decimation         = decimation
+        self.order              = order
+        self.differential_delay = differential_delay
+        self.input_bits         = input_bits
+        self.signed             = signed
+
+        self.gain               = (decimation * differential_delay)**order
+
+        if nr_bits is None:
+            nr_bits = input_bits + int(np.ceil(order * np.log2(decimation * differential_delay)))
+
+        assert nr_bits <= 64, "CIC register width of %d bits doesn't fit in 64 bits" % nr_bits
+
+        self.nr_bits            = nr_bits
+        self.mask               = np.uint64((1 << nr_bits) - 1)
+
+        self.reset()
+
+    def reset(self):
+
+        self.integrators    = np.zeros(self.order, dtype = np.uint64)
+        self.comb_delays    = np.zeros((self.order, self.differential_delay), dtype = np.uint64)
+
+        # Number of input samples since the last output sample
+        self.phase          = 0
+
+    def process(self, x):
+
+        x = np.asarray(x)
+        if x.dtype == np.bool_:
+            x = x.astype(np.uint64)
+        else:
+            # Going through int64 makes negative inputs wrap to their 2's complement value.
+            x = x.astype(np.int64).astype(np.uint64)
+
+        if len(x) == 0:
+            return np.zeros(0, dtype = np.int64)
+
+        # Integrators
+        y = x
+        for stage in range(self.order):
+            y = np.cumsum(y, dtype = np.uint64)
+            y += self.integrators[stage]
+            self.integrators[stage] = y[-1]
+
+        # Decimation
+        y = y[self.decimation-1-self.phase::self.decimation]
+        self.phase = (self.phase + len(x)) % self.decimation
+
+        # Combs
+        M = self.differential_delay
+        for stage in range(self.order):
+            y_dly = np.concatenate([self.comb_delays[stage], y])
+            self.comb_delays[stage] = y_dly[-M:]
+            y = y - y_dly[:len(y)]
+
+        y &= self.mask
+
+        if self.signed:
+            sign_bit = np.uint64(1 << (self.nr_bits-1))
+            return (y ^ sign_bit).astype(np.int64) - (1 << (self.nr_bits-1))
+
+        return y.astype(np.int64)
+
+# Decimating FIR filter that only calculates the output samples that are kept.
+#
+# Every output sample is the dot product of the taps with one window of the input, and
+# consecutive windows are decimation samples apart. This is the polyphase decomposition
+# of the filter, evaluated for all output samples of a chunk with a single matrix product
+# on a strided view of the input.
+#
+# Linear phase filters (symmetric taps) are folded: the two input samples that are
+# multiplied with the same coefficient are added first, which halves the number of
+# multiplications.
+#
+# muls_per_output is the number of multiplications per output sample.
+class FirDecimator:
+
+    def __init__(self, h, decimation, fold = None):
+
+        self.h              = np.asarray(h, dtype = np.float64)
+        self.decimation     = decimation
+
+        if fold is None:
+            fold = np.array_equal(self.h, self.h[::-1])
+
+        self.fold           = fold
+
+        L = len(self.h)
+
+        # Coefficient j of the window is the tap for the oldest sample in the window first.
+        self.h_window       = self.h[::-1].copy()
+
+        if fold:
+            self.muls_per_output = (L+1)//2
+        else:
+            self.muls_per_output = L
+
+        self.reset()
+
+    def reset(self):
+
+        self.history    = np.zeros(len(self.h)-1)
+        self.phase      = 0
+
+    def windows(self, x):
+
+        L = len(self.h)
+
+        if len(x) == 0:
+            return np.zeros((0, L))
+
+        x_ext = np.concatenate([self.history, np.asarray(x, dtype = np.float64)])
+        self.history = x_ext[len(x_ext)-(L-1):]
+
+        w = np.lib.stride_tricks.sliding_window_view(x_ext, L)[self.decimation-1-self.phase::self.decimation]
+        self.phase = (self.phase + len(x)) % self.decimation
+
+        return w
+
+    def process(self, x):
+
+        w = self.windows(x)
+
+        if not self.fold:
+            return w @ self.h_window
+
+        L       = len(self.h)
+        half    = L//2
+
+        y = (w[:, :half] + w[:, ::-1][:, :half]) @ self.h_window[:half]
+        if L % 2 == 1:
+            y += w[:, half] * self.h_window[half]
+
+        return y
+
+# Decimate-by-2 half-band filter, as designed by half_band_calc_filter.
+#
+# Apart from the center tap, all the taps at an even distance from the center are zero.
+# Those are skipped, and the remaining symmetric taps are folded, so an output sample
+# costs (N/2+1)/2 + 1 multiplications for a filter of order N, instead of N+1.
+class HalfBandDecimator(FirDecimator):
+
+    def __init__(self, h):
+
+        h = np.asarray(h, dtype = np.float64)
+        N = len(h)-1
+
+        assert N % 4 == 2, "Half-band filter order must be a multiple of 2, but not a multiple of 4"
+        assert np.array_equal(h, h[::-1]), "Half-band filter must have symmetric taps"
+        assert np.all(h[1:N//2:2] == 0), "Half-band filter taps at an even, nonzero distance from the center must be 0"
+
+        FirDecimator.__init__(self, h, 2, fold = True)
+
+        # Window positions of the non-zero taps that are not the center tap, as pairs of
+        # positions that share the same coefficient.
+        self.pos_lo     = np.arange(0, N//2, 2)
+        self.pos_hi     = N - self.pos_lo
+        self.center     = N//2
+
+        self.muls_per_output = len(self.pos_lo) + 1
+
+    def process(self, x):
+
+        w = self.windows(x)
+
+        y = (w[:, self.pos_lo] + w[:, self.pos_hi]) @ self.h_window[self.pos_lo]
+        y += w[:, self.center] * self.h_window[self.center]
+
+        return y
+
+# A cascade of decimators, e.g. CIC -> HB1 -> HB2 -> FIR, that converts a PDM bit stream
+# into PCM samples.
+#
+# The output of a stage with a 'gain' attribute (a CicDecimator) is divided by that gain,
+# so the cascade has unity DC gain when the stages after it do.
+class DecimationChain:
+
+    def __init__(self, stages):
+
+        self.stages     = stages
+
+    def reset(self):
+
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, x):
+
+        y = x
+        for stage in self.stages:
+            y = stage.process(y)
+            if hasattr(stage, "gain"):
+                y = y / stage.gain
+
+        return y
+
+# CIC decimator for PDM data that is packed 8 samples per byte, as created by np.packbits.
+#
+# The input stays packed all the way: a PDM recording takes 64x less memory than as
+# float64 samples.
+#
+# The CIC filter is evaluated in its direct FIR form, only for the output samples that are
+# kept. For each group of group_bits input samples that falls under the impulse response
+# of an output sample, the weighted sum of the group's bits is precomputed for all 2^group_bits
+# possible values. An output sample is then the sum of one table lookup per group, instead
+# of group_bits additions per stage.
+#
+# The lookup tables depend on where the output sample falls within a group, so there is a
+# set of tables for each position that occurs (group_bits/gcd(decimation, group_bits) of them).
+# With group_bits = 16 these tables can get large (2^16 entries per group of taps and position),
+# but there are only half as many lookups per output sample.
+#
+# bitorder is the same as for np.packbits: with "big", the first sample is the MSB of a byte.
+#
+# The output is identical to that of a CicDecimator with the same parameters that is fed the
+# unpacked bits. Chunks passed to process() must contain a multiple of group_bits/8 bytes.
+class PackedCicDecimator:
+
+    def __init__(self, decimation, order, differential_delay = 1, group_bits = 8, bitorder = "big"):
+
+        assert group_bits in [8, 16], "Only 8-bit and 16-bit groups are supported"
+        assert bitorder in ["big", "little"], "bitorder must be 'big' or 'little'"
+
+        self.decimation         = decimation
+        self.order              = order
+        self.differential_delay = differential_delay
+        self.group_bits         = group_bits
+        self.bitorder           = bitorder
+
+        self.gain               = (decimation * differential_delay)**order
+
+        h = cic_integer_taps(decimation, order, differential_delay)
+        G = group_bits
+
+        # Number of groups that can overlap with the impulse response of an output sample
+        self.nr_slots   = (len(h)-1 + G-1)//G + 1
+
+        if self.gain < 2**31:
+            table_type = np.int32
+        else:
+            table_type = np.int64
+
+        # bits[v, j]: value of sample j of a group with value v
+        values  = np.arange(2**G)
+        if bitorder == "big":
+            bits = (values[:, None] >> (G-1-np.arange(G))[None, :]) & 1
+        else:
+            bits = (values[:, None] >> np.arange(G)[None, :]) & 1
+
+        # A group that ends d groups before the group that contains the output sample, where
+        # the output sample is sample r of its group, contributes
+        #    tables[r, d, v] = sum_j bits[v, j] * h[r + d*G - j]
+        positions = sorted(set((k * decimation - 1) % G for k in range(G)))
+
+        # Only the positions that occur get a set of tables. table_nr maps a position to its set.
+        self.table_nr   = np.zeros(G, dtype = np.int64)
+        self.tables     = np.zeros((len(positions), self.nr_slots, 2**G), dtype = table_type)
+        for (t, r) in enumerate(positions):
+            self.table_nr[r] = t
+            for d in range(self.nr_slots):
+                tap_idx = r + d*G - np.arange(G)
+                valid   = (tap_idx >= 0) & (tap_idx < len(h))
+                taps    = np.where(valid, h[np.clip(tap_idx, 0, len(h)-1)], 0)
+                self.tables[t, d] = bits @ taps
+
+        self.reset()
+
+    def reset(self):
+
+        self.history    = np.zeros(self.nr_slots-1, dtype = np.int64)
+
+        # Number of input samples since the last output sample
+        self.phase      = 0
+
+    def process(self, packed):
+
+        G = self.group_bits
+        R = self.decimation
+
+        groups = np.asarray(packed, dtype = np.uint8)
+        assert len(groups) % (G//8) == 0, "Chunk length must be a multiple of %d bytes" % (G//8)
+
+        groups = groups.astype(np.int64)
+        if G == 16:
+            if self.bitorder == "big":
+                groups = (groups[0::2] << 8) | groups[1::2]
+            else:
+                groups = groups[0::2] | (groups[1::2] << 8)
+
+        nr_bits = len(groups) * G
+
+        groups_ext      = np.concatenate([self.history, groups])
+        self.history    = groups_ext[len(groups_ext)-(self.nr_slots-1):]
+
+        # Index of the last input sample of each output sample, relative to the start of groups_ext
+        history_bits    = (self.nr_slots-1) * G
+        sample_idx      = np.arange(history_bits + R-1-self.phase, history_bits + nr_bits, R)
+        self.phase      = (self.phase + nr_bits) % R
+
+        group_idx       = sample_idx // G
+        table_nr        = self.table_nr[sample_idx % G]
+
+        y = np.zeros(len(sample_idx), dtype = np.int64)
+        for d in range(self.nr_slots):
+            y += self.tables[table_nr, d, groups_ext[group_idx - d]]
+
+        return y
+
+# Bit-true, cycle-accurate model of fpga/spinal/src/main/scala/pdm/PdmFilter.scala.
+#
+# The RTL differs from CicDecimator in a few ways that matter for bit-exact comparisons:
+#
+# - Every integrator is a register whose input is the output register of the previous stage,
+#   so each integrator adds 1 cycle of delay, and integrators_output adds one more.
+#   Integrator k at cycle t is the sum of the stage k-1 values before cycle t.
+# - decim_cntr starts at 0, so sample_vld is high at cycle 0 and then every 'decimation' cycles.
+#   The first sample is the reset value of integrators_output, 0.
+# - The combs are registered pipeline stages that only update when their input is valid,
+#   and combs_output is one more register. pcm_vld is high nr_stages+1 cycles after sample_vld.
+# - All registers are nr_bits wide and wrap around modulo 2^nr_bits. pcm is unsigned.
+#
+# process() takes a chunk of PDM bits, one per clock cycle, and returns (pcm, pcm_vld_cycles):
+# the values of io.pcm at the cycles where io.pcm_vld is high, and those cycle numbers, counted
+# from reset. A sample is returned as soon as its sample_vld cycle has been processed, so its
+# pcm_vld cycle can be slightly beyond the end of the input seen so far.
+class PdmFilterModel:
+
+    def __init__(self, nr_stages = 5, nr_bits = 30, decimation = 50):
+
+        assert nr_bits <= 64, "Register width of %d bits doesn't fit in 64 bits" % nr_bits
+
+        self.nr_stages      = nr_stages
+        self.nr_bits        = nr_bits
+        self.decimation     = decimation
+        self.mask           = np.uint64((1 << nr_bits) - 1)
+        self.latency        = nr_stages + 1
+
+        self.reset()
+
+    def reset(self):
+
+        # Register values at the current cycle
+        self.integrators        = np.zeros(self.nr_stages, dtype = np.uint64)
+        self.integrators_output = np.uint64(0)
+        self.comb_delays        = np.zeros(self.nr_stages, dtype = np.uint64)
+
+        self.cycle              = 0
+
+    def process(self, pdm):
+
+        pdm = np.asarray(pdm).astype(np.uint64) & np.uint64(1)
+        n   = len(pdm)
+
+        if n == 0:
+            return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+
+        # Register values at cycles cycle .. cycle+n: an integrator output one cycle later is
+        # its current value plus its current input.
+        y = pdm
+        for stage in range(self.nr_stages):
+            r = np.empty(n+1, dtype = np.uint64)
+            r[0] = self.integrators[stage]
+            np.cumsum(y[:n], dtype = np.uint64, out = r[1:])
+            r[1:] += self.integrators[stage]
+            self.integrators[stage] = r[n]
+            y = r
+
+        # integrators_output at cycles cycle .. cycle+n-1
+        integrators_output      = np.concatenate([[self.integrators_output], y[:n-1]])
+        self.integrators_output = y[n-1]
+
+        # Samples are taken at the cycles where decim_cntr is 0.
+        first       = -self.cycle % self.decimation
+        samples     = integrators_output[first::self.decimation]
+        vld_cycles  = self.cycle + first + np.arange(len(samples), dtype = np.int64) * self.decimation + self.latency
+
+        self.cycle += n
+
+        # Combs
+        for stage in range(self.nr_stages):
+            if len(samples) == 0:
+                break
+            samples_dly = np.concatenate([[self.comb_delays[stage]], samples[:-1]])
+            self.comb_delays[stage] = samples[-1]
+            samples = samples - samples_dly
+
+        return (samples & self.mask).astype(np.int64), vld_cycles
@@ -1,7 +1,16 @@
 
+import os
+import glob
+import hashlib
+import tempfile
+import collections
+import multiprocessing
+import concurrent.futures
+
 import numpy as np
 import matplotlib
 from matplotlib import pyplot as plt
+import scipy
 from scipy import signal
 
 def pad_zeros(h, N):
@@ -15,9 +24,92 @@ def dB20(array):
     with np.errstate(divide='ignore'):
         return 20 * np.log10(array)
 
+# Sparse table over an array, to find the position of the maximum and the minimum of any
+# range of the array in constant time.
+#
+# argmax_table[k, i] is the position of the maximum of values[i:i+2^k]. A range [lo, hi)
+# is covered by the two (possibly overlapping) power-of-2 ranges that start at lo and that
+# end at hi, so a query is two lookups and a compare, whatever the length of the range.
+#
+# Building the tables takes O(n log n) time and memory. Queries accept arrays of ranges.
+class RangeExtremaIndex:
+
+    def __init__(self, values):
+
+        self.values = np.asarray(values)
+
+        n = len(self.values)
+        nr_levels = max(n.bit_length(), 1)
+
+        self.argmax_table = np.zeros((nr_levels, n), dtype = np.int32)
+        self.argmin_table = np.zeros((nr_levels, n), dtype = np.int32)
+
+        self.argmax_table[0] = np.arange(n)
+        self.argmin_table[0] = np.arange(n)
+
+        for k in range(1, nr_levels):
+            half    = 2**(k-1)
+            valid   = n - 2**k + 1
+
+            a = self.argmax_table[k-1, :valid]
+            b = self.argmax_table[k-1, half:half+valid]
+            self.argmax_table[k, :valid] = np.where(self.values[b] > self.values[a], b, a)
+
+            a = self.argmin_table[k-1, :valid]
+            b = self.argmin_table[k-1, half:half+valid]
+            self.argmin_table[k, :valid] = np.where(self.values[b] < self.values[a], b, a)
+
+    # Positions of the maximum and the minimum of values[lo:hi]. hi must be larger than lo.
+    def query(self, lo, hi):
+
+        lo = np.asarray(lo)
+        hi = np.asarray(hi)
+
+        assert np.all(hi > lo), "Empty range"
+
+        # floor(log2(hi-lo)), exactly
+        k = np.frexp(hi - lo)[1] - 1
+
+        a = self.argmax_table[k, lo]
+        b = self.argmax_table[k, hi - 2**k]
+        i_max = np.where(self.values[b] > self.values[a], b, a)
+
+        a = self.argmin_table[k, lo]
+        b = self.argmin_table[k, hi - 2**k]
+        i_min = np.where(self.values[b] < self.values[a], b, a)
+
+        return i_max, i_min
+
+# Magnitude of the DTFT of h on N equally spaced frequencies over the full circle [0, fsample).
+# N may be smaller than len(h): the taps are then wrapped modulo N first, which gives
+# the exact DTFT samples instead of the truncated response of np.fft.fft(h, N).
+def dtft_grid(h, N):
+
+    h = np.asarray(h, dtype = np.float64)
+
+    if len(h) > N:
+        h = pad_zeros(h, -(-len(h) // N) * N).reshape(-1, N).sum(axis = 0)
+
+    return np.abs(np.fft.fft(h, N))
+
+# Folds a full circle magnitude response onto the output rate of a decimation by 'decimation'.
+#
+# Row r, column x of the result is the response at input bin x + r * len(Habs)/decimation,
+# which lands on output bin x after decimation. Row 0 is the signal itself, the other rows
+# are the components that alias onto it. len(Habs) must be a multiple of decimation.
+def alias_fold(Habs, decimation):
+
+    assert len(Habs) % decimation == 0, "The number of frequency bins must be a multiple of the decimation"
+
+    return np.reshape(Habs, (decimation, -1))
+
+# extrema_index:
+#   precompute a RangeExtremaIndex on Hdb, so that attn_between and attn_between_argmax answer
+#   any band query in constant time instead of scanning the band. Worth it when a filter
+#   is checked against many bands.
 class FilterStats:
 
-    def __init__(self, h, fsample, fcutoff, fstop, N = None):
+    def __init__(self, h, fsample, fcutoff, fstop, N = None, extrema_index = False):
 
         self.h          = h
         self.fsample    = fsample
@@ -33,6 +125,8 @@ class FilterStats:
         
         self.H          = np.fft.fft(h_padded)
 
+        self.use_extrema_index = extrema_index
+
         self.recalc()
 
     def recalc(self):
@@ -42,6 +136,11 @@ class FilterStats:
 
         self.Hdb    = dB20(np.abs(self.H))[self.x_mask]
 
+        if self.use_extrema_index:
+            self.extrema_index = RangeExtremaIndex(self.Hdb)
+        else:
+            self.extrema_index = None
+
         self.pass_max, self.pass_min   = self.attn_between(0, self.fcutoff)
         self.stop_max, self.stop_min   = self.attn_between(self.fstop, None)
 
@@ -63,11 +162,51 @@ class FilterStats:
         x_freq_min = self.freq_to_x(freq_min)
         x_freq_max = self.freq_to_x(freq_max)
 
+        if self.extrema_index is not None:
+            (i_max, i_min) = self.extrema_index.query(x_freq_min, x_freq_max)
+            return self.Hdb[i_max], self.Hdb[i_min]
+
         h_min = np.min(self.Hdb[x_freq_min:x_freq_max])
         h_max = np.max(self.Hdb[x_freq_min:x_freq_max])
 
         return h_max, h_min
 
+    # Like attn_between, but also returns the frequency where the maximum is reached.
+    # freq_min and freq_max can be arrays, to check many bands at once. This builds the
+    # extrema index when the object doesn't have one yet.
+    def attn_between_argmax(self, freq_min, freq_max):
+        if freq_max is None:
+            freq_max = self.fsample/2
+
+        if self.extrema_index is None:
+            self.extrema_index = RangeExtremaIndex(self.Hdb)
+
+        x_freq_min = np.rint(np.asarray(freq_min)/self.fsample*len(self.Hdb)*2).astype(np.int64)
+        x_freq_max = np.rint(np.asarray(freq_max)/self.fsample*len(self.Hdb)*2).astype(np.int64)
+
+        (i_max, i_min) = self.extrema_index.query(x_freq_min, x_freq_max)
+
+        return self.Hdb[i_max], self.Hdb[i_min], i_max * self.fsample / (len(self.Hdb)*2)
+
+    # Magnitude response folded onto the output rate after decimation, see alias_fold.
+    # N must be a multiple of decimation.
+    def alias_matrix(self, decimation):
+        return alias_fold(np.abs(self.H), decimation)
+
+    # Largest component that aliases into the 0 to f_pass band after decimation.
+    #
+    # Returns the attenuation in dB and the input frequency of that component.
+    def worst_alias(self, decimation, f_pass):
+        folded  = self.alias_matrix(decimation)
+        x_pass  = int(f_pass / self.fsample * len(self.H))
+
+        aliases = folded[1:, :x_pass+1]
+        (r, x)  = np.unravel_index(np.argmax(aliases), aliases.shape)
+
+        freq    = ((r+1) * folded.shape[1] + x) * self.fsample / len(self.H)
+
+        return dB20(aliases[r, x]), min(freq, self.fsample - freq)
+
     def __str__(self):
 
         s = ""
@@ -168,19 +307,10 @@ class FilterStats:
         plt.gca().set_ylim([-175, 5.0])
         plt.grid(True)
 
-        Haccum = np.zeros(len(self.H)//decimation//2)
+        folded = self.alias_matrix(decimation)[:, :len(self.H)//decimation//2]
+        Haccum = np.sum(folded, axis = 0)
 
-        for i in range(decimation):
-            x_start = self.freq_to_x(self.fsample/2/decimation * i)
-            x_stop  = self.freq_to_x(self.fsample/2/decimation * (i+1))
-
-            x_new = self.freq_to_x(self.fsample/2/decimation)
-            if i%2==0:
-                Haccum = Haccum + np.abs(self.H[x_start:x_stop])
-                plt.plot(self.freqs[self.x_mask][0:x_new] * self.fsample, self.Hdb[x_start:x_stop])
-            else:
-                Haccum = Haccum + np.abs(np.flip(self.H[x_start:x_stop]))
-                plt.plot(self.freqs[self.x_mask][0:x_new] * self.fsample, np.flip(self.Hdb[x_start:x_stop]))
+        plt.plot(self.freqs[self.x_mask][0:len(Haccum)] * self.fsample, dB20(folded.T))
 
         plt.subplot(413)
         plt.gca().set_xlim([0.0, self.fsample/2/decimation])
@@ -202,6 +332,147 @@ class FilterStats:
         plt.tight_layout()
         plt.savefig(filename)
 
+# Lighter version of FilterStats for sweeps that create many of these objects.
+#
+# - The impulse response is real, so only the non-negative half of the spectrum is calculated
+#   with an rfft, and only the magnitude is kept.
+# - Magnitudes are stored as float32 by default. That's about 1e-6 dB of resolution, which is
+#   plenty for ripple and attenuation checks. Use dtype = np.float64 when it isn't.
+# - Hdb and the pass band and stop band extrema are only calculated when they're first used,
+#   and then cached.
+# - __slots__ avoids a per-object dictionary.
+#
+# The bins are the same as those of FilterStats, so attn_at and attn_between return the same
+# values, up to the float32 rounding.
+class HalfSpectrumFilterStats:
+
+    __slots__ = [ "h", "fsample", "fcutoff", "fstop", "N", "Habs", "extrema_index", "_Hdb", "_pass", "_stop" ]
+
+    def __init__(self, h, fsample, fcutoff, fstop, N = None, dtype = np.float32, extrema_index = False):
+
+        self.h          = h
+        self.fsample    = fsample
+        self.fcutoff    = fcutoff
+        self.fstop      = fstop
+
+        if N is None:
+            self.N      = len(h)
+        else:
+            self.N      = N
+
+        # Same bins as the non-negative frequencies of FilterStats: N//2 for even N, (N+1)//2 for odd N.
+        self.Habs       = np.abs(np.fft.rfft(h, self.N))[:(self.N+1)//2].astype(dtype)
+
+        self._Hdb       = None
+        self._pass      = None
+        self._stop      = None
+
+        if extrema_index:
+            self.extrema_index = RangeExtremaIndex(self.Habs)
+        else:
+            self.extrema_index = None
+
+    @property
+    def Hdb(self):
+        if self._Hdb is None:
+            self._Hdb = dB20(self.Habs)
+
+        return self._Hdb
+
+    @property
+    def freqs(self):
+        return np.arange(len(self.Habs)) / self.N
+
+    @property
+    def x_mask(self):
+        return np.full(len(self.Habs), True)
+
+    @property
+    def pass_max(self):
+        if self._pass is None:
+            self._pass = self.attn_between(0, self.fcutoff)
+
+        return self._pass[0]
+
+    @property
+    def pass_min(self):
+        if self._pass is None:
+            self._pass = self.attn_between(0, self.fcutoff)
+
+        return self._pass[1]
+
+    @property
+    def stop_max(self):
+        if self._stop is None:
+            self._stop = self.attn_between(self.fstop, None)
+
+        return self._stop[0]
+
+    @property
+    def stop_min(self):
+        if self._stop is None:
+            self._stop = self.attn_between(self.fstop, None)
+
+        return self._stop[1]
+
+    # Scaled by 2*len(Habs), not N, like FilterStats scales by 2*len(Hdb): for odd N the
+    # two differ by one, and the band edges must land on the same bins in both classes.
+    def freq_to_x(self, freq):
+        x = int(round((freq/self.fsample)*len(self.Habs)*2))
+
+        return x
+
+    def attn_at(self, freq):
+        x_freq = self.freq_to_x(freq)
+
+        # A single bin doesn't need the full Hdb array.
+        return dB20(self.Habs[x_freq])
+
+    def attn_between(self, freq_min, freq_max):
+        if freq_max is None:
+            freq_max = self.fsample/2
+
+        x_freq_min = self.freq_to_x(freq_min)
+        x_freq_max = self.freq_to_x(freq_max)
+
+        # dB20 is monotonic, so the extrema of the magnitudes are the extrema in dB.
+        if self.extrema_index is not None:
+            (i_max, i_min) = self.extrema_index.query(x_freq_min, x_freq_max)
+            return dB20(self.Habs[i_max]), dB20(self.Habs[i_min])
+
+        h_min = dB20(np.min(self.Habs[x_freq_min:x_freq_max]))
+        h_max = dB20(np.max(self.Habs[x_freq_min:x_freq_max]))
+
+        return h_max, h_min
+
+    # See FilterStats.attn_between_argmax
+    def attn_between_argmax(self, freq_min, freq_max):
+        if freq_max is None:
+            freq_max = self.fsample/2
+
+        if self.extrema_index is None:
+            self.extrema_index = RangeExtremaIndex(self.Habs)
+
+        x_freq_min = np.rint(np.asarray(freq_min)/self.fsample*len(self.Habs)*2).astype(np.int64)
+        x_freq_max = np.rint(np.asarray(freq_max)/self.fsample*len(self.Habs)*2).astype(np.int64)
+
+        (i_max, i_min) = self.extrema_index.query(x_freq_min, x_freq_max)
+
+        return dB20(self.Habs[i_max]), dB20(self.Habs[i_min]), i_max * self.fsample / (len(self.Habs)*2)
+
+    def __str__(self):
+
+        s = ""
+        s += "Filter length: %d\n" % len(self.h)
+        s += "Sample rate: %0.4f\n" % self.fsample
+        s += "Cutoff: %0.4f\n" % self.fcutoff
+        s += "Stop : %0.4f\n" % self.fstop
+        s += "Pass max (db): %0.4f\n" % self.pass_max
+        s += "Pass min (db): %0.4f\n" % self.pass_min
+        s += "Stop max (db): %0.4f\n" % self.stop_max
+
+        return s
+
 def reduce_bits(h, nr_bits):
 
     steps = (2**nr_bits)-1
@@ -217,8 +488,332 @@ def reduce_bits(h, nr_bits):
 
     return h_round, h_int
 
+# Smallest number of bits for which the coefficients of reduce_bits(h, nr_bits) still meet the
+# specification of the filter (same definitions as fir_calc_filter).
+#
+# All candidate widths in 'bits' are quantized into one 2D array and evaluated with one
+# batched FFT of N points (default: 8x the filter length, at least 4096).
+#
+# The unquantized filter is evaluated on the same grid. The design is only checked on a 512
+# point grid, so it may already miss Apb or Asb here. In that case, no width can meet the spec
+# and nr_bits is None, unless relax_dB is given: then the targets become the unquantized
+# filter's own ripple and attenuation, plus or minus relax_dB. The result is then the width that
+# stays within relax_dB of the unquantized filter, not one that meets the spec.
+#
+# Because the quantization error doesn't always decrease with the number of bits, the result is
+# the smallest width for which all larger candidates meet the target as well.
+#
+# Returns (nr_bits, Rpb_dB, Rsb_dB), with Rpb_dB and Rsb_dB the pass band ripple and stop band
+# attenuation for each candidate. nr_bits is None when not even the largest candidate is good
+# enough, or when the unquantized filter misses the spec and relax_dB is None.
+def min_coef_bits(h, Fs, Fpb, Fsb, Apb, Asb, bits = range(2, 33), N = None, relax_dB = None):
+
+    h       = np.asarray(h, dtype = np.float64)
+    bits    = np.asarray(bits)
+
+    if N is None:
+        N = max(4096, 2**int(np.ceil(np.log2(8*len(h)))))
+
+    h_round = np.vstack([ reduce_bits(h, int(b))[0] for b in bits ] + [ h ])
+
+    Habs    = np.abs(np.fft.rfft(h_round, N, axis = 1))
+    freqs   = np.fft.rfftfreq(N) * Fs
+
+    Hpb     = Habs[:, freqs <= Fpb]
+    Hsb     = Habs[:, freqs >= Fsb]
+
+    Rpb_dB  = -dB20(1 - (np.max(Hpb, axis = 1) - np.min(Hpb, axis = 1)))
+    Rsb_dB  = -dB20(np.max(Hsb, axis = 1))
+
+    (Apb_target, Asb_target) = (Apb, Asb)
+    if relax_dB is not None:
+        Apb_target = max(Apb, Rpb_dB[-1] + relax_dB)
+        Asb_target = min(Asb, Rsb_dB[-1] - relax_dB)
+
+    float_ok = (Rpb_dB[-1] <= Apb_target) and (Rsb_dB[-1] >= Asb_target)
+
+    (Rpb_dB, Rsb_dB) = (Rpb_dB[:-1], Rsb_dB[:-1])
+
+    if not float_ok:
+        return None, Rpb_dB, Rsb_dB
+
+    ok      = (Rpb_dB <= Apb_target) & (Rsb_dB >= Asb_target)
+
+    # All candidates from position i onwards must be ok.
+    all_ok  = np.flip(np.logical_and.accumulate(np.flip(ok)))
+
+    if not all_ok[-1]:
+        return None, Rpb_dB, Rsb_dB
+
+    return int(bits[np.argmax(all_ok)]), Rpb_dB, Rsb_dB
+
+# Canonical signed digit (CSD) representation of integers: digits in {-1, 0, 1}, LSB first, without
+# 2 adjacent non-zero digits. This is a minimal signed digit (MSD) representation: no other signed
+# digit representation has fewer non-zero digits, so it gives the fewest adders for a shift-add
+# constant multiplier.
+#
+# Returns an int8 array of shape values.shape + (nr_digits,).
+def csd_digits(values):
+
+    x       = np.array(values, dtype = np.int64)
+    digits  = []
+
+    while True:
+        # For odd x, pick the digit that makes (x - digit) divisible by 4.
+        digit   = np.where(x & 1, 2 - (x & 3), 0)
+        digits.append(digit)
+        x       = (x - digit) >> 1
+
+        if not np.any(x):
+            break
+
+    return np.stack(digits, axis = -1).astype(np.int8)
+
+# Number of adders (or subtractors) needed to multiply one input by all the constants in
+# h_int with shift-add networks (a multiple constant multiplication block, as in the transposed
+# form of an FIR filter).
+#
+# - Equal constants, as in the symmetric taps of a linear phase filter, are only built once.
+#   The same goes for constants that only differ in their sign or by a power of 2.
+# - Each constant starts from its CSD digits: n non-zero digits cost n-1 adders.
+# - With cse, 2-term patterns (a +/- b << d) that occur more than once across all constants
+#   are computed once and shared, most frequent pattern first (Hartley's method).
+def csd_adders(h_int, cse = True):
+
+    h_int   = np.abs(np.asarray(h_int, dtype = np.int64))
+    h_int   = h_int[h_int != 0]
+
+    # Remove the factors of 2.
+    h_odd   = h_int // (h_int & -h_int)
+    h_odd   = np.unique(h_odd)
+
+    if len(h_odd) == 0:
+        return 0
+
+    digits  = csd_digits(h_odd)
+
+    # Each constant is a list of terms (position, sign, symbol). Symbol 0 is the input, symbols
+    # 1 and up are the shared subexpressions.
+    constants = []
+    for row in digits:
+        positions = np.flatnonzero(row)
+        constants.append([ (int(p), int(row[p]), 0) for p in positions ])
+
+    # Replaces the non-overlapping occurrences of pattern by the subexpression symbol.
+    def replace(constants, pattern, symbol):
+        (sym_lo, sym_hi, d, s) = pattern
+
+        nr_replaced = 0
+        result      = []
+        for terms in constants:
+            terms = list(terms)
+            found = True
+            while found:
+                found = False
+                for lo in terms:
+                    for hi in terms:
+                        if hi[0] - lo[0] == d and (lo[2], hi[2]) == (sym_lo, sym_hi) and lo[1] * hi[1] == s and lo < hi:
+                            terms.remove(lo)
+                            terms.remove(hi)
+                            terms.append((lo[0], lo[1], symbol))
+                            found = True
+                            break
+                    if found:
+                        nr_replaced += 1
+                        break
+            result.append(sorted(terms))
+
+        return result, nr_replaced
+
+    nr_subexpressions = 0
+    rejected          = set()
+
+    while cse:
+        counts = collections.Counter()
+
+        for terms in constants:
+            for i in range(len(terms)):
+                for j in range(i+1, len(terms)):
+                    (lo, hi)  = sorted([ terms[i], terms[j] ])
+                    pattern   = (lo[2], hi[2], hi[0] - lo[0], lo[1] * hi[1])
+                    if pattern not in rejected:
+                        counts[pattern] += 1
+
+        if len(counts) == 0:
+            break
+
+        (pattern, count) = counts.most_common(1)[0]
+        if count < 2:
+            break
+
+        # Overlapping occurrences are counted as well, so the real number of
+        # replacements can be lower.
+        (new_constants, nr_replaced) = replace(constants, pattern, nr_subexpressions + 1)
+
+        if nr_replaced < 2:
+            rejected.add(pattern)
+            continue
+
+        constants = new_constants
+        nr_subexpressions += 1
+
+    return sum(len(terms) - 1 for terms in constants) + nr_subexpressions
+
+# Adders per output sample of an FIR filter with integer coefficients h_int and shift-add
+# multipliers: the multiplier block (see csd_adders) and the adders that sum the products
+# of the non-zero taps.
+def fir_adders(h_int, cse = True):
+
+    nr_taps = np.count_nonzero(h_int)
+
+    return csd_adders(h_int, cse = cse) + max(nr_taps - 1, 0)
+
+# Two-tier cache for filter designs that are pure functions of their spec.
+#
+# Tier 1 is an in-process LRU of at most max_entries designs.
+# Tier 2 is a directory of .npz files, one per design, named after a hash of the
+# normalized spec and the scipy version that produced it. When the directory grows
+# beyond max_bytes, the least recently used files are deleted.
+#
+# Designs are tuples of numpy arrays and scalars. The arrays that are handed out
+# are read-only, because the same objects are returned to every caller.
+#
+# Set FILTER_CACHE_DIR in the environment to move the disk cache, or to an empty
+# string to disable it.
+class FilterDesignCache:
+
+    def __init__(self, cache_dir, max_entries = 256, max_bytes = 256 * 1024**2):
+
+        self.cache_dir      = cache_dir
+        self.max_entries    = max_entries
+        self.max_bytes      = max_bytes
+
+        self.memory         = collections.OrderedDict()
+        self.disk_bytes     = None
+
+    def key_hash(self, spec):
+        # Callers pass frequencies normalized to Fs. Rounding them to 12 significant digits
+        # makes specs that only differ in floating point noise map to the same design.
+        spec_str = repr(tuple(("%.12g" % s) if isinstance(s, float) else s for s in spec))
+        spec_str += " scipy=" + scipy.__version__
+
+        return hashlib.sha1(spec_str.encode()).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def lookup(self, spec):
+        key = self.key_hash(spec)
+
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        if not self.cache_dir:
+            return None
+
+        try:
+            with np.load(self.filename(key)) as npz:
+                design = tuple(npz["arr_%d" % i][()] for i in range(len(npz.files)))
+            os.utime(self.filename(key))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return self.remember(key, design)
+
+    def store(self, spec, design):
+        key = self.key_hash(spec)
+
+        design = self.remember(key, design)
+
+        if not self.cache_dir:
+            return design
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok = True)
+
+            # Write to a temporary file and rename, so that concurrent processes never
+            # see a partially written design.
+            (fd, tmp_filename) = tempfile.mkstemp(dir = self.cache_dir, suffix = ".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, *design)
+            os.replace(tmp_filename, self.filename(key))
+        except OSError:
+            return design
+
+        try:
+            self.evict(os.path.getsize(self.filename(key)))
+        except OSError:
+            # Another process may be evicting from the same directory.
+            self.disk_bytes = None
+
+        return design
+
+    def remember(self, key, design):
+        design = tuple(np.array(d) if isinstance(d, np.ndarray) else d for d in design)
+        for d in design:
+            if isinstance(d, np.ndarray):
+                d.setflags(write = False)
+
+        self.memory[key] = design
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last = False)
+
+        return design
+
+    def evict(self, added_bytes):
+        if self.disk_bytes is None:
+            self.disk_bytes = sum(os.path.getsize(f) for f in glob.glob(os.path.join(self.cache_dir, "*.npz")))
+        else:
+            self.disk_bytes += added_bytes
+
+        if self.disk_bytes <= self.max_bytes:
+            return
+
+        files = sorted(glob.glob(os.path.join(self.cache_dir, "*.npz")), key = os.path.getmtime)
+        self.disk_bytes = sum(os.path.getsize(f) for f in files)
+
+        for f in files:
+            if self.disk_bytes <= self.max_bytes:
+                break
+            try:
+                self.disk_bytes -= os.path.getsize(f)
+                os.remove(f)
+            except OSError:
+                pass
+
+    def clear(self, disk = False):
+        self.memory.clear()
+
+        if disk and self.cache_dir:
+            for f in glob.glob(os.path.join(self.cache_dir, "*.npz")):
+                os.remove(f)
+            self.disk_bytes = 0
+
+filter_design_cache = FilterDesignCache(
+        os.environ.get("FILTER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pdm_filter_designs"))
+        )
+
 def fir_calc_filter(Fs, Fpb, Fsb, Apb, Asb, N, verbose = True):
 
+    spec = ("fir", Fpb/Fs, Fsb/Fs, float(Apb), float(Asb), int(N))
+
+    design = filter_design_cache.lookup(spec)
+    if design is None:
+        design = filter_design_cache.store(spec, fir_design_filter(Fs, Fpb, Fsb, Apb, Asb, N))
+
+    (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = design
+
+    if verbose: print("Rpb: %fdB" % (-dB20(Rpb)))
+    if verbose: print("Rsb: %fdB" % -dB20(Rsb))
+
+    return (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max)
+
+# The uncached part of fir_calc_filter.
+def fir_design_filter(Fs, Fpb, Fsb, Apb, Asb, N):
+
     bands = np.array([0., Fpb/Fs, Fsb/Fs, .5])
 
     # Remez weight calculation:
@@ -246,19 +841,121 @@ def fir_calc_filter(Fs, Fpb, Fsb, Apb, Asb, N, verbose = True):
     Hsb_max = max(np.abs(H[int(Fsb/Fs*2 * len(H)+1):len(H)]))
     Rsb = Hsb_max
     
-    if verbose: print("Rpb: %fdB" % (-dB20(Rpb)))
-    if verbose: print("Rsb: %fdB" % -dB20(Rsb))
-
     return (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max)
 
-def fir_find_optimal_N(Fs, Fpb, Fsb, Apb, Asb, Nmin = 1, Nmax = 1000, verbose = True):
-    for N in range(Nmin, Nmax):
+# Analytic estimate of the order of an equiripple low-pass filter.
+#
+# The pass band and stop band ripple are derived the same way as the Remez
+# weights in fir_calc_filter, so the estimate tracks what remez will actually
+# be asked to do.
+#
+# method:
+#   "kaiser"    : N = (-20*log10(sqrt(dp*ds)) - 13) / (14.6 * df)
+#   "bellanger" : N = 2/3 * log10(1/(10*dp*ds)) / df
+#   "herrmann"  : Herrmann, Rabiner, Chan, "Practical Design Rules for Optimum
+#                 Finite Impulse Response Low-Pass Digital Filters" (1973).
+#                 Usually the most accurate of the three.
+def fir_estimate_N(Fs, Fpb, Fsb, Apb, Asb, method = "herrmann"):
+
+    dp = (1 - 10**(-Apb/20))/2
+    ds = 10**(-Asb/20)
+    df = (Fsb - Fpb)/Fs
+
+    if method == "kaiser":
+        N = (-20*np.log10(np.sqrt(dp*ds)) - 13) / (14.6 * df)
+    elif method == "bellanger":
+        N = 2/3 * np.log10(1/(10*dp*ds)) / df
+    elif method == "herrmann":
+        L1 = np.log10(dp)
+        L2 = np.log10(ds)
+
+        D_inf = (0.005309 * L1**2 + 0.07114 * L1 - 0.4761) * L2 - (0.00266 * L1**2 + 0.5941 * L1 + 0.4278)
+        f     = 11.01217 + 0.51244 * (L1 - L2)
+
+        N = D_inf/df - f*df
+    else:
+        assert False, "Unknown order estimation method '%s'" % method
+
+    return max(int(np.ceil(N)), 1)
+
+# Find the smallest order in the lattice Nmin, Nmin+step, ... (Nmax exclusive) for
+# which passes(N) is True, assuming that passes() is monotonic in N.
+#
+# The search starts at N_start (typically an analytic estimate), gallops with
+# doubling steps in the direction of the pass/fail boundary until it is bracketed,
+# and then bisects the bracket. This takes O(log(|N_start-N_opt|)) calls to passes()
+# instead of O(N_opt-Nmin) for a linear scan.
+def order_search(passes, N_start, Nmin, Nmax, step = 1):
+
+    nr_steps = (Nmax - Nmin + step - 1) // step
+    if nr_steps <= 0:
+        return None
+
+    k_start = min(max((N_start - Nmin + step - 1) // step, 0), nr_steps-1)
+
+    # Lattice indices of the highest known failing and lowest known passing order.
+    k_fail  = -1
+    k_pass  = None
+
+    if passes(Nmin + k_start * step):
+        k_pass  = k_start
+        gallop  = 1
+        while k_pass > 0:
+            k = max(k_pass - gallop, 0)
+            if passes(Nmin + k * step):
+                k_pass = k
+                gallop *= 2
+            else:
+                k_fail = k
+                break
+    else:
+        k_fail  = k_start
+        gallop  = 1
+        while k_pass is None:
+            k = min(k_fail + gallop, nr_steps-1)
+            if k == k_fail:
+                return None
+            if passes(Nmin + k * step):
+                k_pass = k
+            else:
+                k_fail = k
+                gallop *= 2
+
+    while k_pass - k_fail > 1:
+        k = (k_fail + k_pass) // 2
+        if passes(Nmin + k * step):
+            k_pass = k
+        else:
+            k_fail = k
+
+    return Nmin + k_pass * step
+
+# search:
+#   "bisect" : start from fir_estimate_N, gallop to a passing order and bisect
+#              down to the minimum. Roughly a dozen remez runs.
+#   "linear" : try every order from Nmin upwards.
+#
+# certify: decide pass/fail with fir_verify_spec instead of the 512 point grid of
+#          fir_calc_filter, which can miss violations between grid points.
+def fir_find_optimal_N(Fs, Fpb, Fsb, Apb, Asb, Nmin = 1, Nmax = 1000, verbose = True, search = "bisect", certify = False):
+
+    def passes(N):
         if verbose: print("Trying N=%d" % N)
         (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = fir_calc_filter(Fs, Fpb, Fsb, Apb, Asb, N, verbose = verbose)
-        if -dB20(Rpb) <= Apb and -dB20(Rsb) >= Asb:
-            return N
+        if certify:
+            return fir_verify_spec(h, Fs, Fpb, Fsb, Apb, Asb)[0]
+        return -dB20(Rpb) <= Apb and -dB20(Rsb) >= Asb
+
+    if search == "linear":
+        for N in range(Nmin, Nmax):
+            if passes(N):
+                return N
 
-    return None
+        return None
+
+    N_est = fir_estimate_N(Fs, Fpb, Fsb, Apb, Asb)
+
+    return order_search(passes, N_est, Nmin, Nmax)
 
 # Fs : sample frequency
 # Fpb: pass-band frequency. 
@@ -277,6 +974,22 @@ def half_band_calc_filter(Fs, Fpb, N, verbose = True):
     assert N % 2 == 0, "Filter order N must be a multiple of 2"
     assert N % 4 != 0, "Filter order N must not be a multiple of 4"
 
+    spec = ("half_band", Fpb/Fs, int(N))
+
+    design = filter_design_cache.lookup(spec)
+    if design is None:
+        design = filter_design_cache.store(spec, half_band_design_filter(Fs, Fpb, N))
+
+    (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = design
+
+    if verbose: print("Rpb: %fdB" % (-dB20(Rpb)))
+    if verbose: print("Rsb: %fdB" % -dB20(Rsb))
+
+    return (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max)
+
+# The uncached part of half_band_calc_filter.
+def half_band_design_filter(Fs, Fpb, N):
+
     g = signal.remez(
             N//2+1,
             [0., 2*Fpb/Fs, .5, .5],
@@ -301,19 +1014,431 @@ def half_band_calc_filter(Fs, Fpb, N, verbose = True):
     Hsb_max = max(np.abs(H[int(Fsb/Fs*2 * len(H)+1):len(H)]))
     Rsb = Hsb_max
     
-    if verbose: print("Rpb: %fdB" % (-dB20(Rpb)))
-    if verbose: print("Rsb: %fdB" % -dB20(Rsb))
-
     return (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max)
 
-def half_band_find_optimal_N(Fs, Fpb, Apb, Asb, Nmin = 2, Nmax = 1000, verbose = True):
-    for N in range(Nmin, Nmax, 4):
+# A half-band filter has the same ripple in the pass band and the stop band, so
+# the order is determined by whichever of the two specs is the tightest.
+def half_band_estimate_N(Fs, Fpb, Apb, Asb, method = "herrmann"):
+
+    delta = min((1 - 10**(-Apb/20))/2, 10**(-Asb/20))
+
+    Apb_eq = -dB20(1 - 2*delta)
+    Asb_eq = -dB20(delta)
+
+    return fir_estimate_N(Fs, Fpb, Fs/2-Fpb, Apb_eq, Asb_eq, method = method)
+
+# Only orders with N % 4 == 2 are considered, starting from Nmin.
+#
+# search:
+#   "bisect" : start from half_band_estimate_N, gallop to a passing order and bisect
+#              down to the minimum.
+#   "linear" : try every valid order from Nmin upwards.
+#
+# certify: decide pass/fail with fir_verify_spec, see fir_find_optimal_N.
+#
+# Returns the order together with the filter that was designed for it:
+# (N, h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max)
+def half_band_find_optimal_N(Fs, Fpb, Apb, Asb, Nmin = 2, Nmax = 1000, verbose = True, search = "bisect", certify = False):
+    assert Nmin % 4 == 2, "Nmin must be a multiple of 2, but not a multiple of 4"
+
+    filters = {}
+
+    def passes(N):
         if verbose: print("Trying N=%d" % N)
-        (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = half_band_calc_filter(Fs, Fpb, N, verbose = verbose)
-        if -dB20(Rpb) <= Apb and -dB20(Rsb) >= Asb:
-            return N
+        filters[N] = half_band_calc_filter(Fs, Fpb, N, verbose = verbose)
+        (h, w, H, Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max) = filters[N]
+        if certify:
+            return fir_verify_spec(h, Fs, Fpb, Fs/2-Fpb, Apb, Asb)[0]
+        return -dB20(Rpb) <= Apb and -dB20(Rsb) >= Asb
+
+    if search == "linear":
+        N = None
+        for N_try in range(Nmin, Nmax, 4):
+            if passes(N_try):
+                N = N_try
+                break
+    else:
+        N_est = half_band_estimate_N(Fs, Fpb, Apb, Asb)
+        N = order_search(passes, N_est, Nmin, Nmax, step = 4)
+
+    if N is None:
+        return None
+
+    return (N,) + filters[N]
+
+# Dense evaluation of the frequency response of an FIR filter over only the bands that
+# matter (pass band, stop band, alias bands), with the chirp-z transform.
+#
+# A chirp-z transform evaluates the response on nr_points equally spaced frequencies between
+# any f_lo and f_hi in O((len(h) + nr_points) log(len(h) + nr_points)) operations, so a
+# 6kHz pass band can get thousands of points without an FFT over the whole sample rate.
+#
+# The number of points is derived from tolerance, the maximum error in linear magnitude
+# of the extrema that are found: for a linear phase filter, |H| = |A(w)| with
+# A(w) = sum(h[k] * cos(w*(k-c))), c = (len(h)-1)/2, so |A''(w)| <= sum(|h[k]| * (k-c)^2) = M2.
+# Around an extremum A'(w) = 0, so the true extremum is at most M2/2 * (dw/2)^2 away
+# from the nearest grid point with spacing dw. Band edges are always on the grid.
+#
+# For filters that are not linear phase, the bound is an estimate.
+class BandEvaluator:
+
+    def __init__(self, h, fsample, tolerance = 1e-6, max_points = 2**20):
+
+        self.h          = np.asarray(h, dtype = np.float64)
+        self.fsample    = fsample
+        self.tolerance  = tolerance
+        self.max_points = max_points
+
+        c = (len(self.h)-1)/2
+        self.M2         = np.sum(np.abs(self.h) * (np.arange(len(self.h)) - c)**2)
+
+    def nr_points(self, f_lo, f_hi):
+
+        if self.M2 == 0:
+            return 2
+
+        dw = np.sqrt(8 * self.tolerance / self.M2)
+        df = dw / (2*np.pi) * self.fsample
+
+        nr_points = int(np.ceil((f_hi - f_lo) / df)) + 1
+
+        assert nr_points <= self.max_points, "Band %f-%f needs %d points for a tolerance of %g" % (f_lo, f_hi, nr_points, self.tolerance)
+
+        return max(nr_points, 2)
+
+    # Returns the frequencies and the magnitude response on nr_points points from f_lo to f_hi,
+    # both included.
+    def response(self, f_lo, f_hi, nr_points = None):
+
+        if nr_points is None:
+            nr_points = self.nr_points(f_lo, f_hi)
+
+        w = np.exp(-2j*np.pi * (f_hi - f_lo) / (nr_points-1) / self.fsample)
+        a = np.exp( 2j*np.pi * f_lo / self.fsample)
+
+        H = signal.czt(self.h, m = nr_points, w = w, a = a)
+
+        return np.linspace(f_lo, f_hi, nr_points), np.abs(H)
+
+    # DTFT of the columns of taps (default: h) at arbitrary frequencies, evaluated directly
+    # from the definition, in chunks to limit the memory use.
+    #
+    # exp(-j*w*k) is built as exp(-j*w*q*B) * exp(-j*w*r) with k = q*B + r and B ~ sqrt(len(h)),
+    # which replaces almost all complex exponentials by multiplications.
+    def dtft(self, freqs, taps = None, chunk_size = 1024):
+
+        if taps is None:
+            taps = self.h
+
+        freqs   = np.asarray(freqs, dtype = np.float64)
+        L       = len(self.h)
+        B       = int(np.ceil(np.sqrt(L)))
+        H       = np.empty(freqs.shape + taps.shape[1:], dtype = np.complex128)
+
+        for start in range(0, len(freqs), chunk_size):
+            f   = freqs[start:start+chunk_size] / self.fsample
+            E_q = np.exp(-2j*np.pi * np.multiply.outer(f, np.arange(0, L, B)))
+            E_r = np.exp(-2j*np.pi * np.multiply.outer(f, np.arange(B)))
+            E   = (E_q[:,:,None] * E_r[:,None,:]).reshape(len(f), -1)[:,:L]
+
+            H[start:start+chunk_size] = E @ taps
+
+        return H
+
+    # Certified maximum (or minimum, when minimum is True) of the magnitude in a band.
+    #
+    # The band is covered by cells: a center frequency w and a half width d (in radians).
+    # With T(w) = sum(h[k] * exp(-j*w*(k-c))), the Taylor expansion of T around the center gives
+    # for any point in the cell:
+    #
+    #   | |T(w+t)| - |T(w)| | <= sum(|T^(i)(w)| * d^i/i!, i = 1..p-1) + sum(|h[k]| * |(k-c)*d|^p)/p!
+    #
+    # and |T| = |H|. The derivatives are only a DTFT of h weighted by (-j*(k-c))^i, so they are
+    # evaluated on the initial grid with a chirp-z transform. Contrary to a global bound on the
+    # derivatives, this bound is tight in a stop band, where the response is small.
+    #
+    # The local extrema of the initial grid are refined with a golden-section search on the DTFT,
+    # and then only the cells whose bound is still more than tolerance beyond the best value
+    # found are split, until there are none left.
+    #
+    # Returns (H_found, H_bound, f_found): H_found is reached at f_found, and the true extremum is
+    # between H_found and H_bound, with |H_bound - H_found| <= tolerance.
+    def certified_extremum(self, f_lo, f_hi, tolerance, minimum = False, max_levels = 64):
+
+        sign        = -1 if minimum else 1
+        k_c         = np.arange(len(self.h)) - (len(self.h)-1)/2
+        abs_h       = np.abs(self.h)
+
+        # About 4 points per ripple of the response.
+        nr_points   = max(int(np.ceil(4 * len(self.h) * (f_hi - f_lo) / self.fsample)) + 1, 3)
+        freqs       = np.linspace(f_lo, f_hi, nr_points)
+        d           = np.pi * (freqs[1] - freqs[0]) / self.fsample
+
+        # Smallest expansion order for which the remainder is negligible on the initial grid.
+        p           = 2
+        while p < 40 and np.sum(abs_h * np.abs(k_c * d)**p) / scipy.special.factorial(p) > tolerance / 4:
+            p += 1
+
+        def remainder(d):
+            return np.sum(abs_h * np.abs(k_c * d)**p) / scipy.special.factorial(p)
+
+        def taylor_taps(d):
+            i = np.arange(p)
+            return self.h[:,None] * (-1j * k_c[:,None] * d)**i / scipy.special.factorial(i)
+
+        # Taylor terms on the initial grid, one chirp-z transform per order.
+        w_step      = np.exp(-2j*np.pi * (f_hi - f_lo) / (nr_points-1) / self.fsample)
+        a           = np.exp( 2j*np.pi * f_lo / self.fsample)
+        terms       = np.abs(signal.czt(taylor_taps(d).T, m = nr_points, w = w_step, a = a)).T
+
+        values      = sign * terms[:,0]
+
+        # Golden-section search around all the local maxima of the grid at once.
+        def g(f):
+            return sign * np.abs(self.dtft(f))
+
+        peaks       = np.flatnonzero((values[1:-1] >= values[:-2]) & (values[1:-1] >= values[2:])) + 1
+        i_best      = np.argmax(values)
+        (g_best, f_best) = (values[i_best], freqs[i_best])
+
+        if len(peaks):
+            ratio       = (np.sqrt(5) - 1) / 2
+            (a, b)      = (freqs[peaks-1], freqs[peaks+1])
+            (c, e)      = (b - ratio * (b - a), a + ratio * (b - a))
+            (gc, ge)    = (g(c), g(e))
+
+            # Stop when the bracket is as small as a cell after a few splits.
+            while np.max(b - a) > (freqs[1] - freqs[0]) / 8:
+                left        = gc > ge
+                (a, b)      = (np.where(left, a, c), np.where(left, e, b))
+                (c, e)      = (np.where(left, b - ratio * (b - a), e), np.where(left, c, a + ratio * (b - a)))
+                g_new       = g(np.where(left, c, e))
+                (gc, ge)    = (np.where(left, g_new, ge), np.where(left, gc, g_new))
+
+            for (g_peak, f_peak) in ((gc, c), (ge, e)):
+                i_peak = np.argmax(g_peak)
+                if g_peak[i_peak] > g_best:
+                    (g_best, f_best) = (g_peak[i_peak], f_peak[i_peak])
+
+        # Split the cells that can still hide a better value.
+        g_bound     = g_best
+
+        for level in range(max_levels):
+            bound       = sign * terms[:,0] + np.sum(terms[:,1:], axis = 1) + remainder(d)
+            open_       = bound > g_best + tolerance
+
+            g_bound     = max(g_bound, np.max(bound[~open_], initial = g_bound))
+
+            if not np.any(open_):
+                break
+
+            freqs       = freqs[open_]
+            d           = d/2
+            freqs       = np.concatenate([freqs - d * self.fsample / (2*np.pi), freqs + d * self.fsample / (2*np.pi)])
+            freqs       = freqs[(freqs >= f_lo) & (freqs <= f_hi)]
+
+            terms       = np.abs(self.dtft(freqs, taylor_taps(d)))
+
+            i_best      = np.argmax(sign * terms[:,0])
+            if sign * terms[i_best,0] > g_best:
+                (g_best, f_best) = (sign * terms[i_best,0], freqs[i_best])
+        else:
+            assert False, "Band %f-%f could not be certified to a tolerance of %g" % (f_lo, f_hi, tolerance)
+
+        return sign * g_best, sign * g_bound, f_best
+
+    # Maximum and minimum magnitude in a band, within tolerance, and the frequency of the maximum.
+    def extrema(self, f_lo, f_hi):
+
+        (freqs, Habs) = self.response(f_lo, f_hi)
+
+        i_max = np.argmax(Habs)
+
+        return Habs[i_max], np.min(Habs), freqs[i_max]
+
+    # Same definitions as fir_calc_filter:
+    # Rpb = 1 - (Hpb_max - Hpb_min), Rsb = Hsb_max
+    def band_stats(self, f_pb, f_sb):
+
+        (Hpb_max, Hpb_min, f_pb_max) = self.extrema(0, f_pb)
+        (Hsb_max, Hsb_min, f_sb_max) = self.extrema(f_sb, self.fsample/2)
+
+        Rpb = 1 - (Hpb_max - Hpb_min)
+        Rsb = Hsb_max
+
+        return (Rpb, Rsb, Hpb_min, Hpb_max, Hsb_max)
+
+    # Worst case magnitude of the signals that alias into the 0 to f_pb pass band when
+    # decimating by 'decimation' after this filter: the maximum over all bands
+    # k*fsample/decimation - f_pb to k*fsample/decimation + f_pb, for k >= 1.
+    #
+    # Returns the magnitude and the frequency where it's reached.
+    def alias_max(self, decimation, f_pb):
+
+        H_max = 0
+        f_max = None
+
+        for k in range(1, decimation//2 + 1):
+            f_lo = k * self.fsample/decimation - f_pb
+            f_hi = min(k * self.fsample/decimation + f_pb, self.fsample/2)
+
+            (H, H_min, f) = self.extrema(f_lo, f_hi)
+            if H > H_max:
+                (H_max, f_max) = (H, f)
+
+        return H_max, f_max
+
+# Checks whether FIR filter h meets a pass band ripple of Apb dB and a stop band attenuation
+# of Asb dB with guaranteed results, instead of relying on a fixed frequency grid: the extrema
+# of each band are bounded to within tolerance_db, and the filter only passes when the worst case
+# bounds meet the specification. A filter that is closer to the specification than tolerance_db
+# may be rejected.
+#
+# h must be linear phase. Fpb and Fsb use the same definitions as fir_calc_filter.
+#
+# Returns (passes, Rpb_dB, Rsb_dB), with Rpb_dB and Rsb_dB the worst case pass band ripple and
+# stop band attenuation.
+def fir_verify_spec(h, Fs, Fpb, Fsb, Apb, Asb, tolerance_db = 0.001):
+
+    assert np.allclose(np.abs(h), np.abs(h[::-1])), "fir_verify_spec requires a linear phase filter"
+
+    evaluator   = BandEvaluator(h, Fs)
+
+    # Convert the dB tolerances to absolute tolerances on the magnitude at the spec limits.
+    tol_pb      = (10**(-Apb/20) - 10**(-(Apb+tolerance_db)/20)) / 2
+    tol_sb      = 10**(-Asb/20) * (10**(tolerance_db/20) - 1)
+
+    (Hpb_max, Hpb_max_bound, f) = evaluator.certified_extremum(0, Fpb, tol_pb)
+    (Hpb_min, Hpb_min_bound, f) = evaluator.certified_extremum(0, Fpb, tol_pb, minimum = True)
+    (Hsb_max, Hsb_max_bound, f) = evaluator.certified_extremum(Fsb, Fs/2, tol_sb)
 
-    return None
+    Rpb_dB      = -dB20(1 - (Hpb_max_bound - Hpb_min_bound))
+    Rsb_dB      = -dB20(Hsb_max_bound)
+
+    return (Rpb_dB <= Apb and Rsb_dB >= Asb), Rpb_dB, Rsb_dB
+
+# Cache of dtft_grid results, shared by all FilterCascade objects so that an optimizer loop
+# that only changes one stage doesn't recalculate the response of the others.
+stage_response_cache            = collections.OrderedDict()
+stage_response_cache_max_entries = 256
+
+def stage_response(h, N):
+
+    h   = np.ascontiguousarray(h, dtype = np.float64)
+    key = (hashlib.sha1(h.tobytes()).hexdigest(), N)
+
+    Habs = stage_response_cache.get(key)
+    if Habs is not None:
+        stage_response_cache.move_to_end(key)
+        return Habs
+
+    Habs = dtft_grid(h, N)
+    Habs.flags.writeable = False
+
+    stage_response_cache[key] = Habs
+    while len(stage_response_cache) > stage_response_cache_max_entries:
+        stage_response_cache.popitem(last = False)
+
+    return Habs
+
+# Composite response of a chain of decimating filters, e.g. CIC -> HB1 -> HB2 -> FIR.
+#
+# stages: list of (h, decimation), each filter h running at the output rate of the previous stage,
+#         the first one at fsample.
+#
+# All responses are evaluated on one grid over the input circle, with nr_bins_out bins per
+# output sample rate so that every fold is exact. The response of each stage is periodic
+# in its own sample rate, so it's evaluated once on its own grid (see stage_response) and tiled.
+#
+# The composite response up to stage i is folded onto the output rate of stage i with alias_fold:
+# the rows that were not in the pass band at the input of stage i are the components that stage i
+# aliases into the pass band. (The other rows were already folded by an earlier stage.)
+class FilterCascade:
+
+    def __init__(self, fsample, stages, nr_bins_out = 4096):
+
+        self.fsample        = fsample
+        self.stages         = stages
+        self.decimations    = [ decimation for (h, decimation) in stages ]
+        self.rates          = fsample / np.cumprod([1] + self.decimations)
+        self.N_in           = nr_bins_out * int(np.prod(self.decimations))
+
+        # Composite response at the input rate after each stage.
+        self.partials       = []
+
+        composite           = np.ones(self.N_in)
+        N_stage             = self.N_in
+
+        for (h, decimation) in stages:
+            composite       = composite * np.tile(stage_response(h, N_stage), self.N_in // N_stage)
+            N_stage         //= decimation
+            self.partials.append(composite)
+
+        self.Habs           = composite
+
+    # Frequencies of the bins of Habs, over the full circle at the input rate.
+    @property
+    def freqs(self):
+        return np.arange(self.N_in) * self.fsample / self.N_in
+
+    # Peak-to-peak variation of the composite response in the 0 to f_pb band, in dB.
+    def passband_ripple(self, f_pb):
+
+        x_pb    = int(f_pb / self.fsample * self.N_in)
+        Hpb     = self.Habs[:x_pb+1]
+
+        return dB20(np.max(Hpb)) - dB20(np.min(Hpb))
+
+    # Returns one dictionary per stage, with the attenuation in dB of the composite response of the
+    # worst aliased component that lands in the 0 to f_pass band at the stage output, and its frequency
+    # at the input of the chain. A stage that doesn't decimate has an alias_attn of -inf.
+    def aliasing(self, f_pass):
+
+        results = []
+        for (i, decimation) in enumerate(self.decimations):
+            f_out       = self.rates[i+1]
+            N_out       = self.N_in // int(round(self.fsample / f_out))
+            x_pass      = int(f_pass / f_out * N_out)
+
+            assert x_pass < N_out//2, "Pass band doesn't fit in the output rate of the stage"
+
+            folded      = alias_fold(self.partials[i], self.N_in // N_out)[:, :x_pass+1]
+            aliased     = np.arange(len(folded)) % decimation != 0
+
+            (alias_attn, alias_freq) = (-np.inf, None)
+
+            if np.any(aliased):
+                aliases     = folded[aliased]
+                (r, x)      = np.unravel_index(np.argmax(aliases), aliases.shape)
+                freq        = (np.flatnonzero(aliased)[r] * N_out + x) * self.fsample / self.N_in
+
+                (alias_attn, alias_freq) = (dB20(aliases[r, x]), min(freq, self.fsample - freq))
+
+            results.append({
+                "f_in":         self.rates[i],
+                "f_out":        f_out,
+                "decimation":   decimation,
+                "alias_attn":   alias_attn,
+                "alias_freq":   alias_freq,
+                })
+
+        return results
+
+    # Checks the complete chain against the overall specification: the pass band ripple of the
+    # composite response must be at most a_pb dB, and no stage may alias anything into the pass band
+    # that is attenuated less than a_sb dB.
+    #
+    # Returns (passes, pb_ripple, alias_attn), with alias_attn the worst attenuation over all stages.
+    def verify(self, f_pb, a_pb, a_sb):
+
+        pb_ripple   = self.passband_ripple(f_pb)
+        alias_attn  = -max(stage["alias_attn"] for stage in self.aliasing(f_pb))
+
+        return (pb_ripple <= a_pb and alias_attn >= a_sb), pb_ripple, alias_attn
+
+# Aliasing analysis of a chain of decimating filters, see FilterCascade.aliasing.
+def cascade_aliasing(fsample, stages, f_pass, nr_bins_out = 4096):
+    return FilterCascade(fsample, stages, nr_bins_out).aliasing(f_pass)
 
 # decimation:
 # This determines the number of samples that are averaged together thus
@@ -326,21 +1451,374 @@ def half_band_find_optimal_N(Fs, Fpb, Apb, Asb, Nmin = 2, Nmax = 1000, verbose =
 # the number of delays in the integrator part of the CIC cascade.
 # The differential delay is almost always 1, or sometimes 2.
 
-def cic_filter(decimation, order, differential_delay = 1):
+# The impulse response of an order N CIC filter consists of the integer coefficients of the
+# polynomial ((1-z^-RM)/(1-z^-1))^N.
+#
+# Order N is calculated from order N-1 by multiplying with (1-z^-RM) and dividing by (1-z^-1),
+# which is a running sum. That's O(length) per order instead of the O(length * RM) of a
+# convolution, and it's exact.
+#
+# All orders that were ever calculated for a (decimation, differential_delay) pair are kept in
+# cic_integer_taps_cache, so a sweep over orders only calculates each order once.
+#
+# Coefficients are int64 as long as their sum (RM)^N fits, Python integers otherwise.
+cic_integer_taps_cache = {}
+
+def cic_integer_taps_upto(decimation, max_order, differential_delay = 1):
 
-        mov_avg_length  = decimation * differential_delay
+    L = decimation * differential_delay
 
-        # Single stage CIC filter
-        # Implemented as generic FIR, because a 'true' CIC filter only works
-        # with lossless integer operations.
-        h_cic_single = np.ones(mov_avg_length) / mov_avg_length
-    
-        # Convolve against itself as much as needed for a higher order CIC filter
-        h_cic = h_cic_single
-        for i in range(order-1):
-            h_cic = np.convolve(h_cic, h_cic_single)
+    taps = cic_integer_taps_cache.setdefault((decimation, differential_delay), [ np.ones(1, dtype = np.int64) ])
+
+    while len(taps) <= max_order:
+        order   = len(taps)
+        prev    = taps[-1]
+
+        if L**order < 2**63:
+            c = np.zeros(len(prev) + L, dtype = np.int64)
+        else:
+            c = np.zeros(len(prev) + L, dtype = object)
+            prev = prev.astype(object)
+
+        c[:len(prev)]   += prev
+        c[L:]           -= prev
+        c = np.cumsum(c)[:len(prev) + L - 1]
+
+        c.setflags(write = False)
+        taps.append(c)
+
+    return taps[1:max_order+1]
+
+def cic_integer_taps(decimation, order, differential_delay = 1):
+    return cic_integer_taps_upto(decimation, order, differential_delay)[order-1]
+
+# normalize:
+# return the impulse response scaled to a DC gain of 1 as float64, instead of the integer
+# coefficients.
+def cic_filter(decimation, order, differential_delay = 1, normalize = True):
+
+        h_cic = cic_integer_taps(decimation, order, differential_delay)
+
+        if not normalize:
+            return h_cic
+
+        gain = (decimation * differential_delay)**order
+
+        # Beyond 2^53, int64 coefficients can't be converted to float64 exactly before the
+        # division. Python integers divide with a correctly rounded result.
+        if gain >= 2**53:
+            h_cic = h_cic.astype(object)
+
+        return (h_cic / gain).astype(np.float64)
+
+# Frequency response statistics of a CIC filter, calculated from the closed form
+#
+#   |H(f)| = |sin(pi*f*R*M) / (R*M * sin(pi*f))|^N
+#
+# with f the frequency normalized to fsample, instead of from an FFT of the impulse response.
+#
+# attn_at() is exact at any frequency, not rounded to the nearest FFT bin. attn_between()
+# evaluates the band edges exactly, and the inside of the band on the same grid of N points
+# over the full sample rate that FilterStats would use.
+#
+# freqs, x_mask and Hdb are provided for plotting, like for FilterStats.
+class CicFilterStats:
+
+    def __init__(self, decimation, order, fsample, fcutoff, fstop, differential_delay = 1, N = 16384):
+
+        self.decimation         = decimation
+        self.order              = order
+        self.differential_delay = differential_delay
+        self.fsample            = fsample
+        self.fcutoff            = fcutoff
+        self.fstop              = fstop
+        self.N                  = N
+
+        self.freqs  = np.arange((N+1)//2) / N
+        self.x_mask = np.full(len(self.freqs), True)
+
+        self.Hdb    = self.response_db(self.freqs * fsample)
+
+        self.pass_max, self.pass_min   = self.attn_between(0, self.fcutoff)
+        self.stop_max, self.stop_min   = self.attn_between(self.fstop, None)
+
+    def response(self, freqs):
+        RM = self.decimation * self.differential_delay
+        f  = np.asarray(freqs, dtype = np.float64) / self.fsample
+
+        # np.sinc(x) = sin(pi*x)/(pi*x), which takes care of f = 0.
+        return np.abs(np.sinc(f * RM) / np.sinc(f))**self.order
+
+    def response_db(self, freqs):
+        return dB20(self.response(freqs))
+
+    def attn_at(self, freq):
+        return self.response_db(freq)[()]
+
+    def attn_between(self, freq_min, freq_max):
+        if freq_max is None:
+            freq_max = self.fsample/2
+
+        f_grid  = self.freqs * self.fsample
+        freqs   = np.concatenate([[freq_min], f_grid[(f_grid > freq_min) & (f_grid < freq_max)], [freq_max]])
+        Hdb     = self.response_db(freqs)
+
+        return np.max(Hdb), np.min(Hdb)
+
+    def __str__(self):
+
+        s = ""
+        s += "CIC decimation: %d\n" % self.decimation
+        s += "CIC order: %d\n" % self.order
+        s += "Differential delay: %d\n" % self.differential_delay
+        s += "Sample rate: %0.4f\n" % self.fsample
+        s += "Cutoff: %0.4f\n" % self.fcutoff
+        s += "Stop : %0.4f\n" % self.fstop
+        s += "Pass max (db): %0.4f\n" % self.pass_max
+        s += "Pass min (db): %0.4f\n" % self.pass_min
+        s += "Stop max (db): %0.4f\n" % self.stop_max
+
+        return s
+
+# Pass band droop and alias attenuation of CIC filters for a whole grid of configurations
+# in one go.
+#
+# The attenuation in dB of a CIC filter of order N is N times that of a single stage, so
+# the closed form response is only evaluated for each (decimation, differential delay)
+# pair, and then broadcast over the orders.
+#
+# pb_attn is the attenuation at f_pb, sb_attn the attenuation at fsample/decimation - f_sb:
+# the lowest frequency that aliases into the stop band after decimation.
+#
+# Returns a structured array of shape (len(decimations), len(orders), len(differential_delays))
+# with fields "decim", "order", "differential_delay", "pb_attn" and "sb_attn".
+cic_grid_dtype = np.dtype([ ("decim", np.int64), ("order", np.int64), ("differential_delay", np.int64),
+                            ("pb_attn", np.float64), ("sb_attn", np.float64) ])
+
+def cic_attenuation_grid(fsample, f_pb, f_sb, decimations, orders, differential_delays = (1,)):
+
+    decim   = np.asarray(decimations)[:, None, None]
+    order   = np.asarray(orders)[None, :, None]
+    delay   = np.asarray(differential_delays)[None, None, :]
+
+    RM      = decim * delay
+
+    f_pass  = f_pb / fsample
+    f_alias = (fsample / decim - f_sb) / fsample
+
+    with np.errstate(divide='ignore'):
+        pb_attn_single = 20 * np.log10(np.abs(np.sinc(f_pass  * RM) / np.sinc(f_pass)))
+        sb_attn_single = 20 * np.log10(np.abs(np.sinc(f_alias * RM) / np.sinc(f_alias)))
+
+    grid = np.zeros((decim.size, order.size, delay.size), dtype = cic_grid_dtype)
+
+    grid["decim"]               = decim
+    grid["order"]               = order
+    grid["differential_delay"]  = delay
+    grid["pb_attn"]             = order * pb_attn_single
+    grid["sb_attn"]             = order * sb_attn_single
+
+    return grid
+
+# Adders per second of a filter stage with output rate f_out, or None when no coefficient width
+# meets the spec.
+def stage_adders(h, coef_bits, f_out):
+
+    if coef_bits is None:
+        return None
+
+    return fir_adders(reduce_bits(h, coef_bits)[1]) * f_out
+
+# Sum of adder counts, None when either one is unknown.
+def add_adders(a, b):
+    return None if a is None or b is None else a + b
+
+# Design all the stages of a PDM to PCM decimation pipeline that starts with a CIC filter
+# and find the number of multiplications per second that are needed.
+#
+# After the CIC filter, there are as many half-band filters as there are factors of 2 in
+# the remaining decimation ratio. When the decimation isn't finished after that, there is
+# a decimating FIR filter (unless single_fir is set), and finally a FIR filter at the
+# output rate.
+#
+# The pass band ripple budget a_pb is split over the stages: each stage gets what's left
+# after the previous stages.
+#
+# Returns a dictionary with the per-stage statistics:
+# { "decim", "stages", "single_fir", "cic_pb_attn", "cic_sb_attn", "hb_stats", "fir_stats",
+#   "hb_muls", "fir_muls", "total_muls", "hb_adders", "fir_adders", "total_adders",
+#   "cascade_ok", "cascade_pb_ripple", "cascade_alias_attn" }
+# "hb_stats" and "fir_stats" are lists with a { "order", "f_out", "muls", "adders", "a_pb", "coef_bits" }
+# dictionary per filter. "coef_bits" is the smallest coefficient width that still meets the
+# spec of the filter, see min_coef_bits, or None when no width does. "adders" is the number of
+# adders per second when the multiplications with these coefficients are done with shift-add
+# networks, see fir_adders. It's None when "coef_bits" is None, and so are the adder totals
+# that include the filter.
+def pdm2pcm_architecture(f_pdm, f_out, f_pb, f_sb, a_pb, a_sb, cic_decim, cic_order, single_fir = False, verbose = False):
+
+    if verbose: print("============================================================")
+    if verbose: print("decim: %d, stages: %d" % (cic_decim, cic_order) )
+    if verbose: print("============================================================")
+
+    result = { "decim" : cic_decim, "stages" : cic_order, "single_fir" : single_fir, "hb_stats" : [], "fir_stats" : [] }
+
+    total_muls  = 0
+    hb_muls     = 0
+    fir_muls    = 0
+
+    total_adders = 0
+    hb_adders    = 0
+    fir_stage_adders = 0
+
+    h_cic_stats = CicFilterStats(cic_decim, cic_order, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb)
+
+    cic_pb_attn = h_cic_stats.attn_at(f_pb)
+    cic_sb_attn = h_cic_stats.attn_at(2*f_pdm/2/cic_decim - f_sb)
+
+    result["cic_pb_attn"] = cic_pb_attn
+    result["cic_sb_attn"] = cic_sb_attn
+
+    cascade_stages = [ (cic_filter(cic_decim, cic_order), cic_decim) ]
+
+    decim_remain    = (f_pdm//cic_decim) // f_out
+    f_s_remain      = f_pdm//cic_decim
+    pb_attn_remain  = a_pb - abs(cic_pb_attn)
+
+    if verbose: print("After CIC: f_s = %d, decim = %d, pb_attn_remain: %.4fdB" % (f_s_remain, decim_remain, pb_attn_remain) )
+
+    # Do as many half-band filters as there are factors of 2 in the remaining decimations
+    while decim_remain % 2 == 0:
+        if verbose: print("------------------------------------------------------------")
+        if verbose: print("Half band: %d -> %d" % (f_s_remain, f_s_remain//2) )
+
+        if verbose: print("pb_attn_remain: %.5fdB" % pb_attn_remain)
+
+        (hb_N, hb_h, hb_w, hb_H, hb_Rpb, hb_Rsb, hb_Hpb_min, hb_Hpb_max, hb_Hsb_max) = half_band_find_optimal_N(f_s_remain, f_sb, pb_attn_remain, a_sb, verbose = False)
+
+        muls = (hb_N/2 + 1) * f_s_remain/2
+        hb_muls += muls
+        total_muls += muls
+
+        if verbose: print("HB muls: %d * %d = %d" % (hb_N/2+1, f_s_remain/2, muls) )
+        if verbose: print("Total mul: %d" % total_muls)
+
+        (coef_bits, Rpb_dB, Rsb_dB) = min_coef_bits(hb_h, f_s_remain, f_sb, f_s_remain/2 - f_sb, pb_attn_remain, a_sb)
+
+        adders = stage_adders(hb_h, coef_bits, f_s_remain/2)
+        hb_adders    = add_adders(hb_adders, adders)
+        total_adders = add_adders(total_adders, adders)
+
+        result["hb_stats"].append({ "order" : hb_N, "f_out" : f_s_remain/2, "muls" : muls, "adders" : adders, "a_pb" : hb_Rpb, "coef_bits" : coef_bits })
+        cascade_stages.append((hb_h, 2))
+
+        decim_remain //= 2
+        f_s_remain //= 2
+        pb_attn_remain -= abs(dB20(hb_Rpb))
+
+    if verbose: print("decim_remain: %d" % decim_remain)
+
+    if decim_remain != 1 and not(single_fir):
+        if verbose: print("------------------------------------------------------------")
+        if verbose: print("Decim FIR: %d -> %d" % (f_s_remain, f_s_remain/decim_remain) )
+
+        if verbose: print("pb_attn_remain: %.5fdB" % (pb_attn_remain))
+
+        fir_N = fir_find_optimal_N(f_s_remain, f_sb, f_s_remain/decim_remain - f_sb, pb_attn_remain/2, a_sb, verbose = False)
+        (fir_h, fir_w, fir_H, fir_Rpb, fir_Rsb, fir_Hpb_min, fir_Hpb_max, fir_Hsb_max) = fir_calc_filter(f_s_remain, f_sb, f_s_remain/decim_remain - f_sb, pb_attn_remain/2, a_sb, fir_N, verbose = False)
+
+        muls = (fir_N + 1) * f_s_remain/decim_remain
+        fir_muls += muls
+        total_muls += muls
+
+        if verbose: print("FIR muls: %d * %d = %d" % (fir_N+1, f_s_remain/decim_remain, muls) )
+        if verbose: print("Total mul: %d" % total_muls)
+
+        (coef_bits, Rpb_dB, Rsb_dB) = min_coef_bits(fir_h, f_s_remain, f_sb, f_s_remain/decim_remain - f_sb, pb_attn_remain/2, a_sb)
+
+        adders = stage_adders(fir_h, coef_bits, f_s_remain/decim_remain)
+        fir_stage_adders = add_adders(fir_stage_adders, adders)
+        total_adders     = add_adders(total_adders, adders)
+
+        result["fir_stats"].append({ "order": fir_N, "f_out": f_s_remain/decim_remain, "muls": muls, "adders": adders, "a_pb": fir_Rpb, "coef_bits": coef_bits })
+        cascade_stages.append((fir_h, int(decim_remain)))
+
+        f_s_remain /= decim_remain
+        decim_remain = 1
+        pb_attn_remain /= 2
+
+    if verbose: print("------------------------------------------------------------")
+    if verbose: print("Final FIR: %d" % (f_s_remain) )
+    if verbose: print("f_pb: %f, f_sb: %f" % (f_pb, f_sb))
+    if verbose: print("pb_attn_remain: %.5fdB" % (pb_attn_remain))
+    if verbose: print("a_sb: %.1fdB" % (a_sb))
+
+    fir_N = fir_find_optimal_N(f_s_remain, f_pb, f_sb, pb_attn_remain, a_sb, verbose = False)
+    (fir_h, fir_w, fir_H, fir_Rpb, fir_Rsb, fir_Hpb_min, fir_Hpb_max, fir_Hsb_max) = fir_calc_filter(f_s_remain, f_pb, f_sb, pb_attn_remain, a_sb, fir_N, verbose = False)
+
+    muls = (fir_N + 1) * f_s_remain/decim_remain
+    fir_muls += muls
+    total_muls += muls
+
+    if verbose: print("FIR muls: %d * %d = %d" % (fir_N+1, f_s_remain/decim_remain, muls) )
+    if verbose: print("Total mul: %d" % total_muls)
+
+    (coef_bits, Rpb_dB, Rsb_dB) = min_coef_bits(fir_h, f_s_remain, f_pb, f_sb, pb_attn_remain, a_sb)
+
+    adders = stage_adders(fir_h, coef_bits, f_s_remain/decim_remain)
+    fir_stage_adders = add_adders(fir_stage_adders, adders)
+    total_adders     = add_adders(total_adders, adders)
+
+    result["fir_stats"].append({ "order": fir_N, "f_out": f_s_remain/decim_remain, "muls": muls, "adders": adders, "a_pb": fir_Rpb, "coef_bits": coef_bits })
+    cascade_stages.append((fir_h, int(decim_remain)))
+
+    # The budget split above adds up dB estimates per stage, check the real end-to-end response.
+    (cascade_ok, cascade_pb_ripple, cascade_alias_attn) = FilterCascade(f_pdm, cascade_stages).verify(f_pb, a_pb, a_sb)
+
+    if verbose: print("Cascade: pass band ripple %.5fdB, alias attenuation %.1fdB, %s" % (cascade_pb_ripple, cascade_alias_attn, "OK" if cascade_ok else "FAIL"))
+
+    result["cascade_ok"]            = cascade_ok
+    result["cascade_pb_ripple"]     = cascade_pb_ripple
+    result["cascade_alias_attn"]    = cascade_alias_attn
+
+    result["hb_muls"]       = hb_muls
+    result["fir_muls"]      = fir_muls
+    result["total_muls"]    = total_muls
+
+    result["hb_adders"]     = hb_adders
+    result["fir_adders"]    = fir_stage_adders
+    result["total_adders"]  = total_adders
+
+    return result
+
+def pdm2pcm_architecture_of_config(args):
+    (filter_specs, cic_config) = args
+
+    return pdm2pcm_architecture(*filter_specs, cic_config["decim"], cic_config["stages"], single_fir = cic_config.get("single_fir", False))
+
+# Evaluate pdm2pcm_architecture for a list of CIC configurations, each a dictionary with
+# "decim", "stages" and optionally "single_fir".
+#
+# The configurations are independent, so they are spread over a pool of nr_processes
+# worker processes (default: one per CPU). The results come back in the order of
+# cic_configs, and every process computes exactly what a serial run would, so the
+# output doesn't depend on the number of processes. nr_processes = 1 runs everything
+# in the current process.
+#
+# Workers are forked so that the calling script doesn't get executed again in every
+# worker. On platforms without fork, the sweep falls back to a serial run.
+def pdm2pcm_architecture_sweep(f_pdm, f_out, f_pb, f_sb, a_pb, a_sb, cic_configs, nr_processes = None):
+
+    filter_specs = (f_pdm, f_out, f_pb, f_sb, a_pb, a_sb)
+    jobs = [ (filter_specs, cic_config) for cic_config in cic_configs ]
+
+    if nr_processes is None:
+        nr_processes = min(len(jobs), os.cpu_count() or 1)
+
+    if nr_processes <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        return [ pdm2pcm_architecture_of_config(job) for job in jobs ]
 
-        return h_cic
+    with concurrent.futures.ProcessPoolExecutor(max_workers = nr_processes, mp_context = multiprocessing.get_context("fork")) as executor:
+        return list(executor.map(pdm2pcm_architecture_of_config, jobs))
 
 def plot_freq_response(w, H, Fs, Fpb, Fsb, Hpb_min, Hpb_max, Hsb_max, Ylim_min = -90):
     plt.title("Frequency Reponse")
@@ -75,9 +75,7 @@ if plot_cic_decimation_passband_droop:
 
     for decim in [2, 3, 4, 6, 8, 12, 16, 24, 48]:
 
-        h_cic = cic_filter(decim, cic_order)
-
-        h_cic_stats = FilterStats(h_cic, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb, N = (16384//decim//2)*decim*2)
+        h_cic_stats = CicFilterStats(decim, cic_order, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb)
         plt.plot(h_cic_stats.freqs[h_cic_stats.x_mask] * f_pdm, h_cic_stats.Hdb, label="Ratio: %d" % (decim))
 
         print("decim: %d - pass band attn: %f" % (decim, h_cic_stats.attn_at(f_pb)))
@@ -102,16 +100,8 @@ if plot_cic_decimation_passband_droop:
 
     for decim in [2, 3, 4, 6, 8, 12, 16, 24, 48]:
         print(decim)
-        mov_avg_length  = decim * cic_differential_delay
-
-        # Single stage CIC filter
-        h_cic_single = np.ones(mov_avg_length) / mov_avg_length
-    
-        h_cic = h_cic_single
-        for i in range(cic_order-1):
-            h_cic = np.convolve(h_cic, h_cic_single)
 
-        h_cic_stats = FilterStats(h_cic, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb, N = (16384//decim//2)*decim*2)
+        h_cic_stats = CicFilterStats(decim, cic_order, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb, differential_delay = cic_differential_delay)
         plt.plot(h_cic_stats.freqs[h_cic_stats.x_mask] * f_pdm, h_cic_stats.Hdb, label="Ratio: %d" % (decim))
 
     rect = plt.Rectangle([100, -a_pb], f_pb-100, 2*a_pb, fill = False)
@@ -142,9 +132,7 @@ if plot_cic_stages_passband_droop:
     for cic_order in range(1, 7):
         print(cic_order)
 
-        h_cic = cic_filter(decim, cic_order)
-
-        h_cic_stats = FilterStats(h_cic, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb, N = (16384//decim//2)*decim*2)
+        h_cic_stats = CicFilterStats(decim, cic_order, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb)
         plt.plot(h_cic_stats.freqs[h_cic_stats.x_mask] * f_pdm, h_cic_stats.Hdb, label="Stages: %d" % (cic_order))
 
     rect = plt.Rectangle([100, -a_pb], f_pb-100, 2*a_pb, fill = False)
@@ -155,272 +143,169 @@ if plot_cic_stages_passband_droop:
     plt.savefig("cic_stages_zoom.svg")
     if save_blog: plt.savefig(BLOG_PATH + "cic_stages_zoom.svg")
 
-if passband_droop_table:
-    #============================================================
-    # Create table with pass band ripple for a matrix of decimation/order combinations
-    #============================================================
+# HTML table with a cell for each decimation ratio (rows) and number of CIC stages (columns)
+# of a cic_attenuation_grid. cell_text formats a grid entry, cell_ok decides whether it
+# meets the spec.
+def cic_grid_table_html(cic_grid, caption, cell_text, cell_ok):
 
     s = ""
 
     s += "<table>\n"
-    s += "<caption style=\"text-align:center\"><b>Pass Band Ripple (dB)</b><br/>Decimation Ratio / Nr of CIC Stages</caption>\n"
+    s += "<caption style=\"text-align:center\"><b>%s</b><br/>Decimation Ratio / Nr of CIC Stages</caption>\n" % caption
     s += "<tr>"
     s += "    <th></th>\n"
-    for cic_order in [1,2,3,4,5,6]:
+    for cic_order in cic_grid["order"][0, :, 0]:
         s += "    <th>%d</th>\n" % cic_order
 
     s += "</tr>\n"
 
-    for decim in [2, 3, 4, 6, 8, 12, 16, 24, 48]:
+    for row in cic_grid[:, :, 0]:
         s += "<tr>\n"
-        s += "    <th>%d</th>\n" % decim
-
-        for cic_order in [1,2,3,4,5,6]:
-
-            h_cic = cic_filter(decim, cic_order)
-
-            h_cic_stats = FilterStats(h_cic, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb, N = (16384//decim//2)*decim*2)
+        s += "    <th>%d</th>\n" % row["decim"][0]
 
-            pb_attn = h_cic_stats.attn_at(f_pb)
-            sb_attn = h_cic_stats.attn_at(2*f_pdm/2/decim - f_sb)
-
-            pb_ok = abs(pb_attn) <= a_pb/2
-
-            if pb_ok:
-                s += "    <td style=\"background-color:#a0e0a0\">%.4f</td>\n" % pb_attn
+        for cell in row:
+            if cell_ok(cell):
+                s += "    <td style=\"background-color:#a0e0a0\">%s</td>\n" % cell_text(cell)
             else:
-                s += "    <td style=\"background-color:#e0a0a0\">%.4f</td>\n" % pb_attn
+                s += "    <td style=\"background-color:#e0a0a0\">%s</td>\n" % cell_text(cell)
 
         s += "</tr>\n"
 
     s += "</table>\n"
 
-    print(s)
+    return s
 
-if stopband_attenuation_table:
+if passband_droop_table or stopband_attenuation_table or passband_stopband_attenuation_table:
+    cic_grid = cic_attenuation_grid(f_pdm, f_pb, f_sb, [2, 3, 4, 6, 8, 12, 16, 24, 48], [1, 2, 3, 4, 5, 6])
+
+if passband_droop_table:
     #============================================================
-    # Create table with stop band attenuation for a matrix of decimation/order combinations
+    # Create table with pass band ripple for a matrix of decimation/order combinations
     #============================================================
 
-    s = ""
-
-    s += "<table>\n"
-    s += "<caption style=\"text-align:center\"><b>Stop Band Attenuation (dB)</b><br/>Decimation Ratio / Nr of CIC Stages</caption>\n"
-    s += "<tr>"
-    s += "    <th></th>\n"
-    for cic_order in [1,2,3,4,5,6]:
-        s += "    <th>%d</th>\n" % cic_order
-
-    s += "</tr>\n"
-
-    for decim in [2, 3, 4, 6, 8, 12, 16, 24, 48]:
-        s += "<tr>\n"
-        s += "    <th>%d</th>\n" % decim
-
-        for cic_order in [1,2,3,4,5,6]:
-
-            h_cic = cic_filter(decim, cic_order)
+    print(cic_grid_table_html(cic_grid, "Pass Band Ripple (dB)",
+            lambda cell: "%.4f" % cell["pb_attn"],
+            lambda cell: abs(cell["pb_attn"]) <= a_pb/2))
 
-            h_cic_stats = FilterStats(h_cic, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb, N = (16384//decim//2)*decim*2)
-
-            pb_attn = h_cic_stats.attn_at(f_pb)
-            sb_attn = h_cic_stats.attn_at(2*f_pdm/2/decim - f_sb)
-
-            sb_ok = abs(sb_attn) >= a_sb
-
-            if sb_ok:
-                s += "    <td style=\"background-color:#a0e0a0\">%.1f</td>\n" % sb_attn
-            else:
-                s += "    <td style=\"background-color:#e0a0a0\">%.1f</td>\n" % sb_attn
-
-        s += "</tr>\n"
-
-    s += "</table>\n"
+if stopband_attenuation_table:
+    #============================================================
+    # Create table with stop band attenuation for a matrix of decimation/order combinations
+    #============================================================
 
-    print(s)
+    print(cic_grid_table_html(cic_grid, "Stop Band Attenuation (dB)",
+            lambda cell: "%.1f" % cell["sb_attn"],
+            lambda cell: abs(cell["sb_attn"]) >= a_sb))
 
 if passband_stopband_attenuation_table:
     #============================================================
     # Create table with pass band ripple and stop band attenuation for a matrix of decimation/order combinations
     #============================================================
 
-    s = ""
+    print(cic_grid_table_html(cic_grid, "Pass Band/Stop Band Attenuation (dB)",
+            lambda cell: "%.4f<br/>%.1f" % (cell["pb_attn"], cell["sb_attn"]),
+            lambda cell: abs(cell["pb_attn"]) <= a_pb/2 and abs(cell["sb_attn"]) >= a_sb))
 
-    s += "<table>\n"
-    s += "<caption style=\"text-align:center\"><b>Pass Band/Stop Band Attenuation (dB)</b><br/>Decimation Ratio / Nr of CIC Stages</caption>\n"
-    s += "<tr>"
-    s += "    <th></th>\n"
-    for cic_order in [1,2,3,4,5,6]:
-        s += "    <th>%d</th>\n" % cic_order
+def muls_table_html(cic_results):
 
+    s = ""
+    s += "<table>\n"
+    s += "<tr>\n"
+    s += "    <th>CIC Config</th>\n"
+    s += "    <th>HB1 mul/s</th>\n"
+    s += "    <th>HB2 mul/s</th>\n"
+    s += "    <th>HB3 mul/s</th>\n"
+    s += "    <th>Decim FIR mul/s</th>\n"
+    s += "    <th>Final FIR mul/s</th>\n"
+    s += "    <th>Total mul/s</th>\n"
     s += "</tr>\n"
-
-    for decim in [2, 3, 4, 6, 8, 12, 16, 24, 48]:
+    for cic_result in cic_results:
         s += "<tr>\n"
-        s += "    <th>%d</th>\n" % decim
-
-        for cic_order in [1,2,3,4,5,6]:
+        s += "    <td>Decim:%d<br/>Stages:%d</td>\n" % (cic_result["decim"], cic_result["stages"])
 
-            h_cic = cic_filter(decim, cic_order)
-
-            h_cic_stats = FilterStats(h_cic, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb, N = (16384//decim//2)*decim*2)
+        for hb_stat in cic_result["hb_stats"]:
+            s += "    <td>%d x %dk = %dk</td>\n" % (hb_stat["order"]/2+1, hb_stat["f_out"]/1000, hb_stat["muls"]/1000)
 
-            pb_attn = h_cic_stats.attn_at(f_pb)
-            sb_attn = h_cic_stats.attn_at(2*f_pdm/2/decim - f_sb)
+        for dummy in range(3-len(cic_result["hb_stats"])):
+            s += "    <td></td>\n"
 
-            pb_ok = abs(pb_attn) <= a_pb/2
-            sb_ok = abs(sb_attn) >= a_sb
+        for dummy in range(2-len(cic_result["fir_stats"])):
+            s += "    <td></td>\n"
 
-            if pb_ok and sb_ok:
-                s += "    <td style=\"background-color:#a0e0a0\">%.4f<br/>%.1f</td>\n" % (pb_attn, sb_attn)
-            else:
-                s += "    <td style=\"background-color:#e0a0a0\">%.4f<br/>%.1f</td>\n" % (pb_attn, sb_attn)
+        for fir_stat in cic_result["fir_stats"]:
+            s += "    <td>%d x %dk = %dk</td>\n" % (fir_stat["order"]+1, fir_stat["f_out"]/1000, fir_stat["muls"]/1000)
 
+        s += "    <td>%dk</td>\n" % (cic_result["total_muls"]/1000)
         s += "</tr>\n"
-
+    
     s += "</table>\n"
 
-    print(s)
-
-if number_of_muls_table:
-    #============================================================
-    # Number of muls table
-    #============================================================
-
-    cic_configs = [ 
-        { "decim" :  6, "stages" : 3,                           "hb_stats" : [], "fir_stats" : [] },
-        { "decim" :  8, "stages" : 4,   "single_fir" : False,   "hb_stats" : [], "fir_stats" : [] },
-        { "decim" :  8, "stages" : 4,   "single_fir" : True,    "hb_stats" : [], "fir_stats" : [] },
-        { "decim" : 12, "stages" : 4,                           "hb_stats" : [], "fir_stats" : [] },
-        ]
-
-    for cic_config in cic_configs:
-        print("============================================================")
-        print("decim: %d, stages: %d" % (cic_config["decim"], cic_config["stages"]) )
-        print("============================================================")
-
-        cic_decim   = cic_config["decim"]
-        cic_order   = cic_config["stages"]
-
-        total_muls  = 0
-        hb_muls     = 0
-        fir_muls    = 0
-
-        h_cic = cic_filter(cic_decim, cic_order)
-
-        h_cic_stats = FilterStats(h_cic, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb, N = (16384//cic_decim//2)*cic_decim*2)
-
-        cic_pb_attn = h_cic_stats.attn_at(f_pb)
-        cic_sb_attn = h_cic_stats.attn_at(2*f_pdm/2/cic_decim - f_sb)
-
-        decim_remain    = (f_pdm//cic_decim) // f_out
-        f_s_remain      = f_pdm//cic_decim
-        pb_attn_remain  = a_pb - abs(cic_pb_attn)
-
-        print("After CIC: f_s = %d, decim = %d, pb_attn_remain: %.4fdB" % (f_s_remain, decim_remain, pb_attn_remain) )
-
-        # Do as many half-band filters as there are factors of 2 in the remaining decimations
-        while decim_remain % 2 == 0:
-            print("------------------------------------------------------------")
-            print("Half band: %d -> %d" % (f_s_remain, f_s_remain//2) )
-
-            print("pb_attn_remain: %.5fdB" % pb_attn_remain)
-
-            hb_N = half_band_find_optimal_N(f_s_remain, f_sb, pb_attn_remain, a_sb, verbose = False)
-            (hb_h, hb_w, hb_H, hb_Rpb, hb_Rsb, hb_Hpb_min, hb_Hpb_max, hb_Hsb_max) = half_band_calc_filter(f_s_remain, f_sb, hb_N)
-
-            muls = (hb_N/2 + 1) * f_s_remain/2
-            hb_muls += muls
-            total_muls += muls
-
-            print("HB muls: %d * %d = %d" % (hb_N/2+1, f_s_remain/2, muls) )
-            print("Total mul: %d" % total_muls)
-
-            cic_config["hb_stats"].append({ "order" : hb_N, "f_out" : f_s_remain/2, "muls" : muls, "a_pb" : hb_Rpb })
-
-            decim_remain //= 2
-            f_s_remain //= 2
-            pb_attn_remain -= abs(dB20(hb_Rpb))
-
-
-        print("decim_remain: %d" % decim_remain)
-
-        if decim_remain != 1 and not(cic_config["single_fir"]):
-            print("------------------------------------------------------------")
-            print("Decim FIR: %d -> %d" % (f_s_remain, f_s_remain/decim_remain) )
+    return s
 
-            print("pb_attn_remain: %.5fdB" % (pb_attn_remain))
+def coef_bits_str(coef_bits):
+    return "spec not met" if coef_bits is None else "%d bits" % coef_bits
 
-            fir_N = fir_find_optimal_N(f_s_remain, f_sb, f_s_remain/decim_remain - f_sb, pb_attn_remain/2, a_sb, verbose = False)
-            (fir_h, fir_w, fir_H, fir_Rpb, fir_Rsb, fir_Hpb_min, fir_Hpb_max, fir_Hsb_max) = fir_calc_filter(f_s_remain, f_sb, f_s_remain/decim_remain - f_sb, pb_attn_remain/2, a_sb, fir_N)
-
-            muls = (fir_N + 1) * f_s_remain/decim_remain
-            fir_muls += muls
-            total_muls += muls
-
-            print("FIR muls: %d * %d = %d" % (fir_N+1, f_s_remain/decim_remain, muls) )
-            print("Total mul: %d" % total_muls)
-
-            cic_config["fir_stats"].append({ "order": fir_N, "f_out": f_s_remain/decim_remain, "muls": muls, "a_pb": fir_Rpb })
-
-            f_s_remain /= decim_remain
-            decim_remain = 1
-            pb_attn_remain /= 2
-
-        print("------------------------------------------------------------")
-        print("Final FIR: %d" % (f_s_remain) )
-        print("f_pb: %f, f_sb: %f" % (f_pb, f_sb))
-        print("pb_attn_remain: %.5fdB" % (pb_attn_remain))
-        print("a_sb: %.1fdB" % (a_sb))
-
-        fir_N = fir_find_optimal_N(f_s_remain, f_pb, f_sb, pb_attn_remain, a_sb, verbose = False)
-        (fir_h, fir_w, fir_H, fir_Rpb, fir_Rsb, fir_Hpb_min, fir_Hpb_max, fir_Hsb_max) = fir_calc_filter(f_s_remain, f_pb, f_sb, pb_attn_remain, a_sb, fir_N)
-
-        muls = (fir_N + 1) * f_s_remain/decim_remain
-        fir_muls += muls
-        total_muls += muls
-
-        print("FIR muls: %d * %d = %d" % (fir_N+1, f_s_remain/decim_remain, muls) )
-        print("Total mul: %d" % total_muls)
-
-        cic_config["fir_stats"].append({ "order": fir_N, "f_out": f_s_remain/decim_remain, "muls": muls, "a_pb": fir_Rpb })
-
-        cic_config["total_muls"] = total_muls
+def stage_adders_str(stat):
+    if stat["adders"] is None:
+        return "spec not met"
+    return "%d x %dk = %dk<br/>(%s)" % (stat["adders"]/stat["f_out"], stat["f_out"]/1000, stat["adders"]/1000, coef_bits_str(stat["coef_bits"]))
 
+# Same layout as muls_table_html, but with the cost of shift-add multipliers, sorted from
+# the cheapest to the most expensive architecture.
+def adders_table_html(cic_results):
 
     s = ""
     s += "<table>\n"
     s += "<tr>\n"
     s += "    <th>CIC Config</th>\n"
-    s += "    <th>HB1 mul/s</th>\n"
-    s += "    <th>HB2 mul/s</th>\n"
-    s += "    <th>HB3 mul/s</th>\n"
-    s += "    <th>Decim FIR mul/s</th>\n"
-    s += "    <th>Final FIR mul/s</th>\n"
-    s += "    <th>Total mul/s</th>\n"
+    s += "    <th>HB1 add/s</th>\n"
+    s += "    <th>HB2 add/s</th>\n"
+    s += "    <th>HB3 add/s</th>\n"
+    s += "    <th>Decim FIR add/s</th>\n"
+    s += "    <th>Final FIR add/s</th>\n"
+    s += "    <th>Total add/s</th>\n"
     s += "</tr>\n"
-    for cic_config in cic_configs:
+    # Architectures with a filter that doesn't meet the spec go last.
+    for cic_result in sorted(cic_results, key = lambda r: (r["total_adders"] is None, r["total_adders"] or 0)):
         s += "<tr>\n"
-        s += "    <td>Decim:%d<br/>Stages:%d</td>\n" % (cic_config["decim"], cic_config["stages"])
+        s += "    <td>Decim:%d<br/>Stages:%d</td>\n" % (cic_result["decim"], cic_result["stages"])
 
-        for hb_stat in cic_config["hb_stats"]:
-            s += "    <td>%d x %dk = %dk</td>\n" % (hb_stat["order"]/2+1, hb_stat["f_out"]/1000, hb_stat["muls"]/1000)
+        for hb_stat in cic_result["hb_stats"]:
+            s += "    <td>%s</td>\n" % stage_adders_str(hb_stat)
 
-        for dummy in range(3-len(cic_config["hb_stats"])):
+        for dummy in range(3-len(cic_result["hb_stats"])):
             s += "    <td></td>\n"
 
-        for dummy in range(2-len(cic_config["fir_stats"])):
+        for dummy in range(2-len(cic_result["fir_stats"])):
             s += "    <td></td>\n"
 
-        for fir_stat in cic_config["fir_stats"]:
-            s += "    <td>%d x %dk = %dk</td>\n" % (fir_stat["order"]+1, fir_stat["f_out"]/1000, fir_stat["muls"]/1000)
+        for fir_stat in cic_result["fir_stats"]:
+            s += "    <td>%s</td>\n" % stage_adders_str(fir_stat)
 
-        s += "    <td>%dk</td>\n" % (cic_config["total_muls"]/1000)
+        s += "    <td>%s</td>\n" % ("spec not met" if cic_result["total_adders"] is None else "%dk" % (cic_result["total_adders"]/1000))
         s += "</tr>\n"
-    
+
     s += "</table>\n"
 
-    print(s)
+    return s
+
+if number_of_muls_table:
+    #============================================================
+    # Number of muls table
+    #============================================================
+
+    cic_configs = [ 
+        { "decim" :  6, "stages" : 3                          },
+        { "decim" :  8, "stages" : 4,   "single_fir" : False  },
+        { "decim" :  8, "stages" : 4,   "single_fir" : True   },
+        { "decim" : 12, "stages" : 4                          },
+        ]
+
+    # The configurations are evaluated in parallel. Use nr_processes = 1 to run them
+    # one after the other.
+    cic_results = pdm2pcm_architecture_sweep(f_pdm, f_out, f_pb, f_sb, a_pb, a_sb, cic_configs)
+
+    print(muls_table_html(cic_results))
+    print(adders_table_html(cic_results))
 
 if plot_pdm2pcm_filters:
     #============================================================
@@ -437,7 +322,7 @@ if plot_pdm2pcm_filters:
 
 
     h_cic = cic_filter(cic_decim, cic_order)
-    h_cic_stats = FilterStats(h_cic, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb, N = (16384//cic_decim//2)*cic_decim*2)
+    h_cic_stats = CicFilterStats(cic_decim, cic_order, fsample = f_pdm, fcutoff = f_pb, fstop = f_sb)
 
     plt.subplot(421)
     plt.grid(True)
@@ -470,8 +355,7 @@ if plot_pdm2pcm_filters:
     # HB1 Filter
     #============================================================
 
-    hb1_N = half_band_find_optimal_N(f_s_remain, f_sb, pb_attn_remain, a_sb, verbose = False)
-    (hb1_h, hb1_w, hb1_H, hb1_Rpb, hb1_Rsb, hb1_Hpb_min, hb1_Hpb_max, hb1_Hsb_max) = half_band_calc_filter(f_s_remain, f_sb, hb1_N)
+    (hb1_N, hb1_h, hb1_w, hb1_H, hb1_Rpb, hb1_Rsb, hb1_Hpb_min, hb1_Hpb_max, hb1_Hsb_max) = half_band_find_optimal_N(f_s_remain, f_sb, pb_attn_remain, a_sb, verbose = False)
 
     plt.subplot(423)
     plt.grid(True)
@@ -501,8 +385,7 @@ if plot_pdm2pcm_filters:
     # HB2 Filter
     #============================================================
 
-    hb2_N = half_band_find_optimal_N(f_s_remain, f_sb, pb_attn_remain, a_sb, verbose = False)
-    (hb2_h, hb2_w, hb2_H, hb2_Rpb, hb2_Rsb, hb2_Hpb_min, hb2_Hpb_max, hb2_Hsb_max) = half_band_calc_filter(f_s_remain, f_sb, hb2_N)
+    (hb2_N, hb2_h, hb2_w, hb2_H, hb2_Rpb, hb2_Rsb, hb2_Hpb_min, hb2_Hpb_max, hb2_Hsb_max) = half_band_find_optimal_N(f_s_remain, f_sb, pb_attn_remain, a_sb, verbose = False)
 
     plt.subplot(425)
     plt.grid(True)
@@ -561,6 +444,17 @@ if plot_pdm2pcm_filters:
     plt.savefig("pdm2pcm_filters.svg")
     if save_blog: plt.savefig(BLOG_PATH + "pdm2pcm_filters.svg")
 
+    # pb_attn_remain splits the pass band budget by adding dB numbers of the individual
+    # stages. Check the budget on the end-to-end response instead.
+    cascade = FilterCascade(f_pdm, [ (h_cic, cic_decim), (hb1_h, 2), (hb2_h, 2), (fir_h, 1) ])
+    (cascade_ok, cascade_pb_ripple, cascade_alias_attn) = cascade.verify(f_pb, a_pb, a_sb)
+
+    print("Cascade pass band ripple: %.4fdB (budget: %.4fdB)" % (cascade_pb_ripple, a_pb))
+    for stage in cascade.aliasing(f_pb):
+        if stage["decimation"] > 1:
+            print("Aliasing %d -> %d: %.1fdB at %.0fHz" % (stage["f_in"], stage["f_out"], stage["alias_attn"], stage["alias_freq"]))
+    print("Cascade meets spec: %s" % cascade_ok)
+
 
 
 
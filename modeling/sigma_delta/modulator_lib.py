@@ -0,0 +1,406 @@
+import os
+import glob
+import hashlib
+import tempfile
+import collections
+
+import numpy as np
+import scipy
+from scipy.linalg import inv, norm, orth
+from scipy.signal import zpk2ss
+
+# Batched simulation of sigma-delta modulators.
+#
+# deltasigma.simulateDSM simulates one modulator with one input, with a Python loop
+# iteration per sample. ModulatorBank simulates any number of independent channels, each
+# with its own NTF and input, with one vectorized step per sample for the whole batch.
+# Modulators of different orders share a batch: the state of the lower order ones is
+# padded with states that stay zero.
+
+# Loop filter of a modulator with NTF ntf = (zeros, poles, k) and an STF of 1, realized
+# the same way as simulateDSM does it: the quantizer input is y = x[0] + u and the next
+# state is A x + B1 u + B2 v.
+#
+# Returns (A, B1, B2).
+def ntf_state_space(ntf):
+
+    zeros = np.atleast_1d(ntf[0])
+    poles = np.atleast_1d(ntf[1])
+    order = len(zeros)
+
+    # A realization of -1/H, transformed so that C = [1 0 0 ...]
+    (A, B2, C, D2) = zpk2ss(poles, zeros, -1)
+    C = np.real_if_close(C)
+
+    Sinv = orth(np.hstack((np.transpose(C), np.eye(order)))) / norm(C)
+    S    = inv(Sinv)
+    C    = np.dot(C, Sinv)
+    if C[0, 0] < 0:
+        S    = -S
+        Sinv = -Sinv
+
+    A  = np.real(np.dot(np.dot(S, A), Sinv))
+    B2 = np.real(np.dot(S, B2))[:, 0]
+
+    return (A, -B2, B2)
+
+# Same quantizer as deltasigma.ds_quantize: odd integers in [-nlev+1, nlev-1] for an even
+# number of levels, even integers in [-nlev, nlev] for an odd number of levels.
+def quantize(y, nlev = 2):
+
+    if nlev == 2:
+        return np.where(y >= 0, 1.0, -1.0)
+
+    if nlev % 2 == 0:
+        v = 2 * np.floor(0.5 * y) + 1
+    else:
+        v = 2 * np.floor(0.5 * (y + 1))
+
+    return np.clip(v, -(nlev-1), nlev-1)
+
+# Sine wave test input, as used by the sigma-delta plots: a tone at freq times the
+# signal bandwidth N/(2*OSR), rounded down to an FFT bin.
+def sine_input(N, OSR, amplitude = 0.5, freq = 2/3):
+
+    fB    = int(np.ceil(N/(2.*OSR)))
+    ftest = np.floor(freq * fB)
+
+    return amplitude * np.sin(2*np.pi*ftest/N*np.arange(N))
+
+class ModulatorBank:
+
+    # ntfs:  list of NTFs in (zeros, poles, k) form, one per channel.
+    # nlev:  number of quantizer levels.
+    # bound: when not None, a channel is considered unstable, and is no longer simulated,
+    #        as soon as the magnitude of its first state exceeds bound.
+    #
+    # The first state is the quantizer input minus the modulator input. It stays within a few
+    # times the quantizer range for stable modulators of any order, and grows by orders of
+    # magnitude when a modulator becomes unstable. The other states of this realization scale
+    # with the order: a stable 6th order modulator reaches 1e5.
+    def __init__(self, ntfs, nlev = 2, bound = None):
+
+        self.nr_channels = len(ntfs)
+        self.nlev        = nlev
+        self.bound       = bound
+
+        realizations = [ ntf_state_space(ntf) for ntf in ntfs ]
+
+        self.orders = np.array([ len(A) for (A, B1, B2) in realizations ])
+        self.order  = int(max(self.orders))
+
+        self.A  = np.zeros((self.nr_channels, self.order, self.order))
+        self.B1 = np.zeros((self.nr_channels, self.order))
+        self.B2 = np.zeros((self.nr_channels, self.order))
+
+        for (ch, (A, B1, B2)) in enumerate(realizations):
+            n = len(A)
+            self.A [ch, :n, :n] = A
+            self.B1[ch, :n]     = B1
+            self.B2[ch, :n]     = B2
+
+        self.reset()
+
+    def reset(self):
+        self.x           = np.zeros((self.nr_channels, self.order))
+        self.xmax        = np.zeros((self.nr_channels, self.order))
+        self.nr_samples  = 0
+
+        # Sample at which each channel crossed the bound, -1 for channels that are still stable.
+        self.unstable_at = np.full(self.nr_channels, -1)
+
+    def unstable(self):
+        return self.unstable_at >= 0
+
+    # u: (nr_channels, N) array of inputs, or a 1D array that is applied to all channels.
+    #
+    # Returns the (nr_channels, N) array of quantizer outputs. The outputs of unstable
+    # channels are 0 after the sample at which they crossed the bound. The modulator states
+    # are kept, so a long input can be simulated in pieces. self.xmax holds the maximum
+    # magnitude that each state reached since the last reset, like xmax of simulateDSM.
+    def simulate(self, u, chunk_size = 256):
+
+        u = np.broadcast_to(np.asarray(u, dtype = np.float64), (self.nr_channels, np.shape(u)[-1]))
+        N = u.shape[1]
+
+        # Time major, so that each step reads contiguous rows.
+        u = np.ascontiguousarray(u.T)
+
+        v = np.zeros((N, self.nr_channels))
+
+        # Only the stable channels are simulated. The arrays of the simulated channels are
+        # compacted each time a channel becomes unstable, so the cost of a step only depends
+        # on the number of channels that are left.
+        active = np.flatnonzero(~self.unstable())
+
+        A    = self.A[active]
+        B1   = self.B1[active]
+        B2   = self.B2[active]
+        x    = self.x[active]
+        xmax = self.xmax[active]
+
+        bound = np.inf if self.bound is None else self.bound
+
+        # A chunk is restarted after a channel becomes unstable, with the remaining channels.
+        start = 0
+        while start < N and len(active) > 0:
+            u_chunk  = u[start:start+chunk_size, active]
+            Bu_chunk = u_chunk[:, :, None] * B1
+            v_chunk  = np.empty_like(u_chunk)
+
+            nr_done = len(u_chunk)
+            for i in range(len(u_chunk)):
+                vi = quantize(x[:, 0] + u_chunk[i], self.nlev)
+                v_chunk[i] = vi
+
+                x = np.matmul(A, x[:, :, None])[:, :, 0] + (Bu_chunk[i] + B2 * vi[:, None])
+                np.maximum(xmax, np.abs(x), out = xmax)
+
+                if xmax[:, 0].max() > bound:
+                    nr_done = i+1
+                    break
+
+            v[start:start+nr_done, active] = v_chunk[:nr_done]
+
+            self.x   [active] = x
+            self.xmax[active] = xmax
+
+            start += nr_done
+
+            diverged = xmax[:, 0] > bound
+            if diverged.any():
+                self.unstable_at[active[diverged]] = self.nr_samples + start - 1
+
+                keep   = ~diverged
+                active = active[keep]
+                (A, B1, B2, x, xmax) = (A[keep], B1[keep], B2[keep], x[keep], xmax[keep])
+
+        self.nr_samples += N
+
+        return v.T
+
+# Simulates every combination of NTF, sine amplitude and sine frequency in one batch.
+#
+# ntfs: dict of NTFs indexed by (order, OSR).
+#
+# Returns a dict of quantizer outputs, indexed by (order, OSR, amplitude, freq).
+def simulate_sweep(ntfs, N, amplitudes = (0.5,), freqs = (2/3,), nlev = 2):
+
+    keys = [ (order, OSR, amplitude, freq) for (order, OSR) in ntfs for amplitude in amplitudes for freq in freqs ]
+
+    bank = ModulatorBank([ ntfs[(order, OSR)] for (order, OSR, amplitude, freq) in keys ], nlev)
+    u    = np.array([ sine_input(N, OSR, amplitude, freq) for (order, OSR, amplitude, freq) in keys ])
+    v    = bank.simulate(u)
+
+    return dict(zip(keys, v))
+
+# Maximum stable amplitude of a sine wave input, for each of the ntfs, indexed by (order, OSR).
+#
+# All NTFs are simulated for all amplitudes in one batch, for N samples or until they cross
+# bound (see ModulatorBank). The result is the largest amplitude below which all amplitudes
+# are stable, or 0 if the smallest one is already unstable.
+#
+# Returns (max_amplitudes, unstable_at): dicts indexed by (order, OSR). unstable_at has,
+# for each amplitude, the sample at which the modulator was found unstable, or -1.
+def max_stable_amplitude(ntfs, N, amplitudes = np.arange(0.05, 1.0, 0.05), freq = 2/3, nlev = 2, bound = 100.):
+
+    amplitudes = np.sort(amplitudes)
+    keys       = list(ntfs)
+
+    bank = ModulatorBank([ ntfs[key] for key in keys for amplitude in amplitudes ], nlev, bound)
+    bank.simulate(np.array([ sine_input(N, OSR, amplitude, freq) for (order, OSR) in keys for amplitude in amplitudes ]))
+
+    unstable_at = bank.unstable_at.reshape(len(keys), len(amplitudes))
+
+    max_amplitudes = {}
+    for (key, row) in zip(keys, unstable_at):
+        nr_stable = np.argmax(row >= 0) if (row >= 0).any() else len(row)
+        max_amplitudes[key] = amplitudes[nr_stable-1] if nr_stable > 0 else 0.
+
+    return (max_amplitudes, dict(zip(keys, unstable_at)))
+
+# Two-tier cache of NTFs and simulated modulator outputs, so that plots and sweeps that use
+# the same modulators and test signals don't synthesize and simulate them again.
+#
+# NTFs are indexed by (order, OSR, opt), modulator outputs of a sine wave input (see
+# sine_input()) by (order, OSR, opt, N, freq, amplitude).
+#
+# Tier 1 is an in-process LRU of at most max_entries objects.
+# Tier 2 is a directory with one file per object, named after a hash of its key and the
+# scipy version: .npz files for NTFs, and .npy files of int8 quantizer outputs for the
+# modulator outputs. The latter are returned as read-only memory maps, so a sweep over
+# hundreds of test streams only reads the parts that are used. When the directory grows
+# beyond max_bytes, the least recently used files are deleted.
+#
+# Set SIGMA_DELTA_CACHE_DIR in the environment to move the disk cache, or to an empty
+# string to disable it.
+class ModulatorCache:
+
+    def __init__(self, cache_dir, max_entries = 1024, max_bytes = 256 * 1024**2):
+
+        self.cache_dir      = cache_dir
+        self.max_entries    = max_entries
+        self.max_bytes      = max_bytes
+
+        self.memory         = collections.OrderedDict()
+        self.disk_bytes     = None
+
+    def key_hash(self, key):
+        key_str = repr(tuple(("%.12g" % k) if isinstance(k, float) else k for k in key))
+        key_str += " scipy=" + scipy.__version__
+
+        return hashlib.sha1(key_str.encode()).hexdigest()
+
+    def filename(self, key_hash, ext):
+        return os.path.join(self.cache_dir, key_hash + ext)
+
+    # NTF (zeros, poles, k) of synthesizeNTF(order, OSR, opt).
+    def ntf(self, order, OSR, opt = 1):
+
+        key_hash = self.key_hash(("ntf", order, OSR, opt))
+
+        ntf = self.lookup(key_hash, ".npz")
+        if ntf is None:
+            # Only needed on a cache miss, so that the simulation itself doesn't depend on
+            # the deltasigma package.
+            from deltasigma import synthesizeNTF
+
+            (zeros, poles, k) = synthesizeNTF(order, OSR, opt)
+            ntf = self.store(key_hash, ".npz", (np.atleast_1d(zeros), np.atleast_1d(poles), np.array(k)))
+
+        (zeros, poles, k) = ntf
+
+        return (zeros, poles, float(k))
+
+    # Modulator outputs for a list of keys (order, OSR, opt, N, freq, amplitude).
+    # The outputs that aren't cached yet are simulated together in one ModulatorBank.
+    def pdm(self, keys, nlev = 2):
+
+        key_hashes = [ self.key_hash(("pdm", nlev) + tuple(key)) for key in keys ]
+        outputs    = [ self.lookup(key_hash, ".npy") for key_hash in key_hashes ]
+
+        missing = [ i for (i, v) in enumerate(outputs) if v is None ]
+        if missing:
+            bank = ModulatorBank([ self.ntf(keys[i][0], keys[i][1], keys[i][2]) for i in missing ], nlev)
+
+            # Inputs of different lengths are padded, which doesn't change the outputs
+            # before the end of each input.
+            N = max(keys[i][3] for i in missing)
+            u = np.zeros((len(missing), N))
+            for (j, i) in enumerate(missing):
+                (order, OSR, opt, Ni, freq, amplitude) = keys[i]
+                u[j, :Ni] = sine_input(Ni, OSR, amplitude, freq)
+
+            v = bank.simulate(u).astype(np.int8)
+
+            for (j, i) in enumerate(missing):
+                outputs[i] = self.store(key_hashes[i], ".npy", v[j, :keys[i][3]])
+
+        return outputs
+
+    # Modulator outputs for all combinations of orders, OSRs, amplitudes and tone frequencies,
+    # in a dict indexed by (order, OSR, opt, N, freq, amplitude).
+    def pdm_sweep(self, orders, OSRs, N, amplitudes = (0.5,), freqs = (2/3,), opt = 1, nlev = 2):
+
+        keys = [ (order, OSR, opt, N, freq, amplitude) for order in orders for OSR in OSRs for amplitude in amplitudes for freq in freqs ]
+
+        return dict(zip(keys, self.pdm(keys, nlev)))
+
+    def lookup(self, key_hash, ext):
+
+        if key_hash in self.memory:
+            self.memory.move_to_end(key_hash)
+            return self.memory[key_hash]
+
+        if not self.cache_dir:
+            return None
+
+        filename = self.filename(key_hash, ext)
+        try:
+            if ext == ".npy":
+                obj = np.load(filename, mmap_mode = "r")
+            else:
+                with np.load(filename) as npz:
+                    obj = tuple(npz["arr_%d" % i] for i in range(len(npz.files)))
+            os.utime(filename)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return self.remember(key_hash, obj)
+
+    def store(self, key_hash, ext, obj):
+
+        if self.cache_dir:
+            filename = self.filename(key_hash, ext)
+            try:
+                os.makedirs(self.cache_dir, exist_ok = True)
+
+                # Write to a temporary file and rename, so that concurrent processes never
+                # see a partially written file.
+                (fd, tmp_filename) = tempfile.mkstemp(dir = self.cache_dir, suffix = ".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    if ext == ".npy":
+                        np.save(f, obj)
+                    else:
+                        np.savez(f, *obj)
+                os.replace(tmp_filename, filename)
+
+                if ext == ".npy":
+                    obj = np.load(filename, mmap_mode = "r")
+
+                self.evict(os.path.getsize(filename))
+            except OSError:
+                # Another process may be evicting from the same directory.
+                self.disk_bytes = None
+
+        return self.remember(key_hash, obj)
+
+    def remember(self, key_hash, obj):
+
+        for a in (obj if isinstance(obj, tuple) else (obj,)):
+            if isinstance(a, np.ndarray) and not isinstance(a, np.memmap):
+                a.setflags(write = False)
+
+        self.memory[key_hash] = obj
+        self.memory.move_to_end(key_hash)
+
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last = False)
+
+        return obj
+
+    def cache_files(self):
+        return glob.glob(os.path.join(self.cache_dir, "*.npy")) + glob.glob(os.path.join(self.cache_dir, "*.npz"))
+
+    def evict(self, added_bytes):
+        if self.disk_bytes is None:
+            self.disk_bytes = sum(os.path.getsize(f) for f in self.cache_files())
+        else:
+            self.disk_bytes += added_bytes
+
+        if self.disk_bytes <= self.max_bytes:
+            return
+
+        files = sorted(self.cache_files(), key = os.path.getmtime)
+        self.disk_bytes = sum(os.path.getsize(f) for f in files)
+
+        for f in files:
+            if self.disk_bytes <= self.max_bytes:
+                break
+            try:
+                self.disk_bytes -= os.path.getsize(f)
+                os.remove(f)
+            except OSError:
+                pass
+
+    def clear(self, disk = False):
+        self.memory.clear()
+
+        if disk and self.cache_dir:
+            for f in self.cache_files():
+                os.remove(f)
+            self.disk_bytes = 0
+
+modulator_cache = ModulatorCache(
+        os.environ.get("SIGMA_DELTA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sigma_delta"))
+        )
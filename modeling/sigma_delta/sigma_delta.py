@@ -8,6 +8,7 @@ from matplotlib import pyplot as plt
 from scipy import signal
 from deltasigma import *
 from filter_lib import *
+from modulator_lib import *
 
 save_blog   = False
 
@@ -28,7 +29,7 @@ plot_noise_slope_different_orders               = True
 
 class SignalInfo:
 
-    def __init__(self, N, sdInfo):
+    def __init__(self, N, sdInfo, v = None):
 
         self.N      = N
         self.OSD    = sdInfo.OSR
@@ -37,14 +38,29 @@ class SignalInfo:
         self.fB     = int(np.ceil(self.N/(2.*sdInfo.OSR)))
 
         self.ftest  = np.floor(self.freq * self.fB)
-        self.u      = 0.5*np.sin(2*np.pi*self.ftest/self.N*np.arange(self.N))
-        self.v, xn, xmax, y = simulateDSM(self.u, sdInfo.H)
+        self.u      = sine_input(self.N, sdInfo.OSR, 0.5, self.freq)
+
+        if v is None:
+            (v,) = modulator_cache.pdm([ signal_key(N, sdInfo) ])
+        self.v      = np.asarray(v, dtype = np.float64)
+
+def signal_key(N, sdInfo):
+    return (sdInfo.order, sdInfo.OSR, sdInfo.opt, N, 2/3, 0.5)
+
+# SignalInfo for each of the sdInfos, with all modulators that aren't cached yet simulated
+# in one batch.
+def signal_infos(N, sdInfos):
+
+    v = modulator_cache.pdm([ signal_key(N, sdInfo) for sdInfo in sdInfos ])
+
+    return [ SignalInfo(N, sdInfo, v[i]) for (i, sdInfo) in enumerate(sdInfos) ]
 
 class SigmaDeltaInfo:
     def __init__(self, order, OSR, name=""):
         self.order      = order
         self.OSR        = OSR
-        self.H          = synthesizeNTF(order, OSR, opt=1)
+        self.opt        = 1
+        self.H          = modulator_cache.ntf(order, OSR, opt=self.opt)
 
 def sigma_delta_sinewave_graph(signalInfo, samplesShown = 301):
 
@@ -259,16 +275,11 @@ if plot_sinewave_to_pdm_different_orders:
     OSR = 16
 
     sd1  = SigmaDeltaInfo(1, OSR)
-    sinewave_sd1  = SignalInfo(8192, sd1 )
-
     sd2  = SigmaDeltaInfo(2, OSR)
-    sinewave_sd2  = SignalInfo(8192, sd2 )
-
     sd3  = SigmaDeltaInfo(3, OSR)
-    sinewave_sd3  = SignalInfo(8192, sd3 )
-
     sd4  = SigmaDeltaInfo(4, OSR)
-    sinewave_sd4  = SignalInfo(8192, sd4 )
+
+    (sinewave_sd1, sinewave_sd2, sinewave_sd3, sinewave_sd4) = signal_infos(8192, [ sd1, sd2, sd3, sd4 ])
 
     plt.figure(figsize=(10,8))
     plt.subplot(411)
@@ -301,16 +312,11 @@ if plot_sinewave_pdm_psd_different_orders:
     OSR = 16
 
     sd1  = SigmaDeltaInfo(1, OSR)
-    sinewave_sd1  = SignalInfo(8192, sd1 )
-
     sd2  = SigmaDeltaInfo(2, OSR)
-    sinewave_sd2  = SignalInfo(8192, sd2 )
-
     sd3  = SigmaDeltaInfo(3, OSR)
-    sinewave_sd3  = SignalInfo(8192, sd3 )
-
     sd4  = SigmaDeltaInfo(4, OSR)
-    sinewave_sd4  = SignalInfo(8192, sd4 )
+
+    (sinewave_sd1, sinewave_sd2, sinewave_sd3, sinewave_sd4) = signal_infos(8192, [ sd1, sd2, sd3, sd4 ])
 
     plt.figure(figsize=(10,14))
     plt.subplot(411)
@@ -341,13 +347,10 @@ if plot_sinewave_pdm_psd_different_orders:
 
 if plot_sinewave_to_pdm_different_osr:
     sd1  = SigmaDeltaInfo(4, 16)
-    sinewave_sd1  = SignalInfo(8192, sd1 )
-
     sd2  = SigmaDeltaInfo(4, 32)
-    sinewave_sd2  = SignalInfo(8192, sd2 )
-
     sd3  = SigmaDeltaInfo(4, 64)
-    sinewave_sd3  = SignalInfo(8192, sd3 )
+
+    (sinewave_sd1, sinewave_sd2, sinewave_sd3) = signal_infos(8192, [ sd1, sd2, sd3 ])
 
     plt.figure(figsize=(10,6))
     plt.subplot(311)
@@ -374,13 +377,10 @@ if plot_sinewave_to_pdm_different_osr:
 
 if plot_sinewave_pdm_psd_different_osr:
     sd1  = SigmaDeltaInfo(4, 16)
-    sinewave_sd1  = SignalInfo(8192, sd1 )
-
     sd2  = SigmaDeltaInfo(4, 32)
-    sinewave_sd2  = SignalInfo(8192, sd2 )
-
     sd3  = SigmaDeltaInfo(4, 64)
-    sinewave_sd3  = SignalInfo(8192, sd3 )
+
+    (sinewave_sd1, sinewave_sd2, sinewave_sd3) = signal_infos(8192, [ sd1, sd2, sd3 ])
 
     np.save("sine_ord4_osr64.npy", sinewave_sd3.v)
 
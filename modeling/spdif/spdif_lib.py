@@ -0,0 +1,485 @@
+import numpy as np
+
+# Python models of the S/PDIF transmitter in fpga/spinal/src/main/scala/pdm/SpdifOut.scala.
+
+# Preambles as they are sent, one value per half time slot. SpdifOut drives these as
+# absolute levels, not relative to the previous level: all of them start with a 1 and end with a 0.
+B_PREAMBLE  = np.array([1,1,1,0,1,0,0,0], dtype = np.uint8)
+M_PREAMBLE  = np.array([1,1,1,0,0,0,1,0], dtype = np.uint8)
+W_PREAMBLE  = np.array([1,1,1,0,0,1,0,0], dtype = np.uint8)
+
+# Bit positions in a subframe (time slots 0 to 3 are the preamble).
+DATA_LSB    = 4
+V_BIT       = 28
+U_BIT       = 29
+C_BIT       = 30
+P_BIT       = 31
+
+FRAMES_PER_BLOCK = 192
+
+# Bit-identical model of SpdifOut, vectorized over all subframes at once.
+#
+# nr_channels, nr_bits:
+#   maxNrChannels and maxNrBitsPerSample of AudioIntfcConfig.
+#
+# encode() takes a (nr_frames, nr_channels) array of samples, the values of io.audio_samples
+# when audio_samples_rdy is raised for each frame, and returns the values of the spdif_out register
+# after every tick of the clock divider: 2 per time slot, 64 per subframe. See line_to_cycles()
+# to get io.spdif per clock cycle.
+#
+# Like the RTL:
+# - the sample is left aligned in the 24 bit data field and sent LSB first,
+# - V and U are 0, C is always 1, P makes the parity of bits 4 to 31 even,
+# - B starts every block of 192 frames, M the first subframe of the other frames, W the others,
+# - every time slot starts with a transition and has a second one in the middle for a 1.
+#
+# The frame counter is kept between calls, so a PCM stream can be encoded in chunks.
+class SpdifEncoder:
+
+    def __init__(self, nr_channels = 2, nr_bits = 16):
+
+        assert nr_bits <= 24, "S/PDIF samples can't have more than 24 bits"
+
+        self.nr_channels    = nr_channels
+        self.nr_bits        = nr_bits
+
+        self.reset()
+
+    def reset(self):
+        self.frame_nr = 0
+
+    # Bits 0 to 31 of output_data for every subframe, as a (nr_subframes, 32) uint8 array.
+    def subframe_bits(self, pcm):
+
+        pcm     = np.asarray(pcm, dtype = np.int64).reshape(-1, self.nr_channels)
+        n       = pcm.size
+
+        data    = (pcm.reshape(-1) & ((1 << self.nr_bits) - 1)) << (24 - self.nr_bits)
+
+        bits    = np.zeros((n, 32), dtype = np.uint8)
+        bits[:, DATA_LSB:DATA_LSB+24] = (data[:, None] >> np.arange(24)) & 1
+        bits[:, C_BIT]  = 1
+        bits[:, P_BIT]  = np.bitwise_xor.reduce(bits[:, DATA_LSB:P_BIT], axis = 1)
+
+        return bits
+
+    def encode(self, pcm):
+
+        bits    = self.subframe_bits(pcm)
+        n       = len(bits)
+
+        line    = np.empty((n, 64), dtype = np.uint8)
+
+        # Preambles
+        subframe_nr = np.arange(n) % self.nr_channels
+        frame_nr    = (self.frame_nr + np.arange(n) // self.nr_channels) % FRAMES_PER_BLOCK
+
+        line[:, :8] = np.where((subframe_nr != 0)[:, None], W_PREAMBLE,
+                      np.where((frame_nr == 0)[:, None],    B_PREAMBLE, M_PREAMBLE))
+
+        # Biphase mark: the level toggles at the start of every time slot, and in the middle
+        # of a time slot with a 1. The level before the first data time slot is the last
+        # preamble value, which is always 0.
+        toggles         = np.ones((n, 56), dtype = np.uint8)
+        toggles[:, 1::2] = bits[:, DATA_LSB:]
+        line[:, 8:]     = np.bitwise_xor.accumulate(toggles, axis = 1) ^ line[:, 7:8]
+
+        self.frame_nr   = (self.frame_nr + n // self.nr_channels) % FRAMES_PER_BLOCK
+
+        return line.reshape(-1)
+
+# io.spdif for every clock cycle after reset, for a clkDivRatio of clk_div_ratio: the register
+# is 0 during the first cycle, and tick k of the line is visible from cycle k*clk_div_ratio+1
+# for clk_div_ratio cycles.
+def line_to_cycles(line, clk_div_ratio = 1):
+    return np.concatenate([ np.zeros(1, dtype = np.uint8), np.repeat(line, clk_div_ratio) ])
+
+#============================================================
+# Decoding
+#============================================================
+
+PREAMBLES   = np.array([ B_PREAMBLE, M_PREAMBLE, W_PREAMBLE ])
+PREAMBLE_NAMES = np.array([ b"B", b"M", b"W" ])
+# The preambles as 8 bit numbers, first half time slot in the MSB.
+PREAMBLE_CODES = (PREAMBLES.astype(np.int64) << np.arange(7, -1, -1)).sum(axis = 1)
+
+subframe_dtype = np.dtype([
+    ("position",        np.int64),      # index of the first half time slot of the preamble
+    ("preamble",        "S1"),          # b"B", b"M" or b"W"
+    ("sample",          np.int32),      # the top nr_bits of the data field, sign extended
+    ("v",               np.uint8),
+    ("u",               np.uint8),
+    ("c",               np.uint8),
+    ("parity_error",    np.bool_),
+    ])
+
+# Streaming biphase-mark decoder for the output of SpdifOut.
+#
+# decode() takes the line levels per half time slot, in chunks of any size, and returns a
+# structured array with one subframe_dtype entry per complete subframe.
+#
+# The decoder synchronizes on a preamble (a run of 3 ones can't occur in biphase-mark data), and
+# then checks every subframe: it must start with a valid preamble, and every data time slot must
+# start with a transition. When that's not the case, it searches for the next preamble. Only
+# the samples of the last, incomplete, subframe are kept between calls, so memory use doesn't
+# depend on the length of the stream.
+#
+# The preambles of a call are all located up front, and a candidate must be followed by a valid
+# subframe before the decoder considers itself synchronized. After that, the subframes are
+# checked in windows that double in size up to max_rows, so data that keeps losing sync, like
+# noise or a wrong half_slot_time, still takes time proportional to its length.
+class SpdifDecoder:
+
+    max_rows = 1 << 14
+
+    def __init__(self, nr_bits = 16):
+
+        self.nr_bits = nr_bits
+        self.reset()
+
+    def reset(self):
+
+        self.buffer     = np.zeros(0, dtype = np.uint8)
+        # Position of self.buffer[0] in the stream
+        self.offset     = 0
+        self.synced     = False
+
+    # Positions of all preambles in buf.
+    def find_preambles(self, buf):
+
+        if len(buf) < 8:
+            return np.zeros(0, dtype = np.int64)
+
+        # All preambles start with 1110, which only occurs once per subframe in valid data.
+        candidates = np.flatnonzero(buf[:-7] & buf[1:-6] & buf[2:-5] & (1 - buf[3:-4]))
+        codes      = (buf[candidates[:, None] + np.arange(8)].astype(np.int64) << np.arange(7, -1, -1)).sum(axis = 1)
+
+        return candidates[np.isin(codes, PREAMBLE_CODES)]
+
+    # For each row of 64 half time slots, whether it's a valid subframe.
+    def valid_rows(self, rows):
+
+        valid   = np.any(np.all(rows[:, None, :8] == PREAMBLES, axis = 2), axis = 1)
+        # Every data time slot starts with a transition.
+        valid  &= np.all(rows[:, 8::2] != rows[:, 7:-1:2], axis = 1)
+
+        return valid
+
+    def decode_subframes(self, rows, positions):
+
+        bits    = rows[:, 8::2] ^ rows[:, 9::2]
+
+        data    = (bits[:, :24].astype(np.int64) << np.arange(24)).sum(axis = 1)
+        sample  = data >> (24 - self.nr_bits)
+        sign    = 1 << (self.nr_bits - 1)
+
+        subframes = np.zeros(len(rows), dtype = subframe_dtype)
+        subframes["position"]       = positions
+        subframes["preamble"]       = PREAMBLE_NAMES[np.argmax(np.all(rows[:, None, :8] == PREAMBLES, axis = 2), axis = 1)]
+        subframes["sample"]         = (sample ^ sign) - sign
+        subframes["v"]              = bits[:, V_BIT - DATA_LSB]
+        subframes["u"]              = bits[:, U_BIT - DATA_LSB]
+        subframes["c"]              = bits[:, C_BIT - DATA_LSB]
+        subframes["parity_error"]   = np.bitwise_xor.reduce(bits, axis = 1) != 0
+
+        return subframes
+
+    def decode(self, half_slots):
+
+        buf     = np.concatenate([ self.buffer, np.asarray(half_slots, dtype = np.uint8) & 1 ])
+        pos     = 0
+        results = []
+
+        preambles = self.find_preambles(buf)
+        nr_rows   = 1
+
+        while True:
+            if not self.synced:
+                j = np.searchsorted(preambles, pos)
+                if j == len(preambles):
+                    # Keep the tail that may still contain the start of a preamble.
+                    pos = max(pos, len(buf) - 7)
+                    break
+
+                pos = preambles[j]
+                if pos + 64 > len(buf):
+                    break
+
+                if not self.valid_rows(buf[pos:pos+64].reshape(1, 64))[0]:
+                    pos += 1
+                    continue
+
+                self.synced = True
+                nr_rows     = 1
+
+            nr_rows = min(nr_rows, (len(buf) - pos) // 64)
+            if nr_rows == 0:
+                break
+
+            rows    = buf[pos:pos + nr_rows*64].reshape(nr_rows, 64)
+            valid   = self.valid_rows(rows)
+
+            nr_valid = nr_rows if np.all(valid) else np.argmin(valid)
+
+            positions = self.offset + pos + 64 * np.arange(nr_valid)
+            results.append(self.decode_subframes(rows[:nr_valid], positions))
+
+            pos += 64 * nr_valid
+
+            if nr_valid < nr_rows:
+                # Lost sync: search again from the next half slot.
+                pos += 1
+                self.synced = False
+            else:
+                nr_rows = min(2 * nr_rows, self.max_rows)
+
+        self.buffer  = buf[pos:]
+        self.offset += pos
+
+        if len(results) == 0:
+            return np.zeros(0, dtype = subframe_dtype)
+
+        return np.concatenate(results)
+
+# Indices of the subframes of the runs of length subframes that begin at starts, as a
+# (nr_runs, length) array. Runs that aren't complete, because they extend beyond the last subframe
+# or a subframe is missing, are dropped: every subframe must start 64 half time slots after the
+# previous one.
+def subframe_runs(subframes, starts, length):
+
+    starts = starts[starts + length <= len(subframes)]
+
+    # Number of gaps in the stream before each subframe.
+    gaps   = np.concatenate([ [ 0 ], np.cumsum(np.diff(subframes["position"]) != 64) ])
+    starts = starts[gaps[starts + length - 1] == gaps[starts]]
+
+    return starts[:, None] + np.arange(length)
+
+# PCM samples of decoded subframes as a (nr_frames, nr_channels) array. Frames start at a B or M
+# preamble, followed by nr_channels-1 W subframes. Incomplete frames, e.g. after a coding
+# violation, are dropped.
+def subframes_to_pcm(subframes, nr_channels = 2):
+
+    frames = subframe_runs(subframes, np.flatnonzero(subframes["preamble"] != b"W"), nr_channels)
+    frames = frames[np.all(subframes["preamble"][frames[:, 1:]] == b"W", axis = 1)]
+
+    return subframes["sample"][frames]
+
+# Channel status bits of decoded subframes as a (nr_blocks, nr_channels, 192) array, one row of
+# 192 bits per complete block that starts with a B preamble.
+def channel_status_blocks(subframes, nr_channels = 2):
+
+    blocks = subframe_runs(subframes, np.flatnonzero(subframes["preamble"] == b"B"), FRAMES_PER_BLOCK * nr_channels)
+
+    c = subframes["c"][blocks].astype(np.uint8).reshape(-1, FRAMES_PER_BLOCK, nr_channels)
+
+    return c.transpose(0, 2, 1)
+
+#============================================================
+# VCD files
+#============================================================
+
+# Whitespace separated tokens of a file, as numpy bytes arrays of about block_size bytes each.
+def token_blocks(f, block_size):
+
+    remainder = b""
+    while True:
+        block = f.read(block_size)
+        if not block:
+            if remainder:
+                yield np.array([ remainder ])
+            return
+
+        block = remainder + block
+        parts = block.split()
+
+        # The last token may continue in the next block.
+        remainder = b""
+        if parts and not block[-1:].isspace():
+            remainder = parts.pop()
+
+        if parts:
+            yield np.array(parts)
+
+# Streaming reader of the value changes of one signal in a VCD file, e.g. waves.vcd of
+# fpga/tb/spdif.
+#
+# signal is the reference name ("io_spdif") or the full hierarchical name ("SpdifOut.io_spdif").
+#
+# The file is read in blocks of block_size bytes and split into tokens, which are then filtered
+# with numpy operations, so the whole file is never in memory.
+#
+# Yields (times, values) numpy arrays per block, for every change of the signal. For vectors,
+# values holds the integer value. x and z bits are read as 0.
+def vcd_changes(filename, signal, block_size = 1 << 24):
+
+    with open(filename, "rb") as f:
+
+        blocks = token_blocks(f, block_size)
+
+        # Header, parsed token by token.
+        scope   = []
+        var_id  = None
+        tokens  = np.zeros(0, dtype = "S1")
+        i       = 0
+
+        def next_token():
+            nonlocal tokens, i
+            while i >= len(tokens):
+                tokens = next(blocks)
+                i = 0
+            i += 1
+            return tokens[i-1]
+
+        while True:
+            t = next_token()
+            if t == b"$scope":
+                next_token()
+                scope.append(next_token().decode())
+            elif t == b"$upscope":
+                scope.pop()
+            elif t == b"$var":
+                next_token()
+                size    = int(next_token())
+                ident   = next_token()
+                ref     = next_token().decode()
+                if var_id is None and signal in (ref, ".".join(scope + [ ref ])):
+                    (var_id, var_size) = (ident, size)
+            elif t == b"$enddefinitions":
+                next_token()
+                break
+
+        assert var_id is not None, "Signal %s not found in %s" % (signal, filename)
+
+        scalar_values = [ v + var_id for v in (b"0", b"1", b"x", b"X", b"z", b"Z") ]
+
+        # Value changes
+        time        = 0
+        # A vector value at the end of a block, whose identifier is in the next block.
+        carry       = np.zeros(0, dtype = "S1")
+
+        def body_blocks():
+            yield tokens[i:]
+            yield from blocks
+
+        for tokens in body_blocks():
+            tokens = np.concatenate([ carry, tokens ])
+            if len(tokens) == 0:
+                continue
+
+            first       = tokens.astype("S1")
+
+            # Vector values start with b or r, but so can identifiers. A vector value is always
+            # followed by its identifier, so in a run of tokens that start with b or r, the vector
+            # values are every other token, starting with the first one of the run.
+            looks_vector    = np.isin(first, [ b"b", b"B", b"r", b"R" ])
+            run_start       = looks_vector & ~np.concatenate([ [ False ], looks_vector[:-1] ])
+            index           = np.arange(len(tokens))
+            run_offset      = index - np.maximum.accumulate(np.where(run_start, index, 0))
+            is_vector       = looks_vector & (run_offset % 2 == 0)
+
+            # Keep a vector value at the end for the next block, together with its identifier.
+            carry = tokens[:0]
+            if is_vector[-1]:
+                carry = tokens[-1:]
+                (tokens, first, is_vector) = (tokens[:-1], first[:-1], is_vector[:-1])
+                if len(tokens) == 0:
+                    continue
+
+            # Identifiers that follow a vector value are not time stamps or scalar value changes.
+            after_vector        = np.empty(len(tokens), dtype = np.bool_)
+            after_vector[0]     = False
+            after_vector[1:]    = is_vector[:-1]
+
+            is_time     = (first == b"#") & ~after_vector
+
+            if var_size == 1:
+                changes = np.flatnonzero(np.isin(tokens, scalar_values) & ~after_vector)
+                values  = (first[changes] == b"1").astype(np.int64)
+            else:
+                # The value is the token before the identifier.
+                changes = np.flatnonzero((tokens == var_id) & after_vector)
+                values  = np.array([ int(v[1:].replace(b"x", b"0").replace(b"X", b"0").replace(b"z", b"0").replace(b"Z", b"0"), 2)
+                                     for v in tokens[changes-1] ], dtype = np.int64)
+
+            # Only the time stamps right before a change, and the last one of the block, are parsed.
+            time_pos    = np.flatnonzero(is_time)
+            time_nr     = np.searchsorted(time_pos, changes) - 1
+            needed      = np.unique(np.concatenate([ time_nr, [ len(time_pos)-1 ] ]))
+            needed      = needed[needed >= 0]
+
+            # times[0] is the last time stamp of the previous blocks.
+            times       = np.zeros(len(time_pos) + 1, dtype = np.int64)
+            times[0]    = time
+            times[needed + 1] = np.char.lstrip(tokens[time_pos[needed]], b"#").astype(np.int64)
+
+            change_times = times[time_nr + 1]
+            time         = times[-1]
+
+            if len(changes):
+                yield change_times, values
+
+# Converts value changes into one level per half time slot of the S/PDIF signal.
+#
+# half_slot_time is the duration of a half time slot in VCD time units: 2 * clkDivRatio for the
+# fpga/tb/spdif test bench, which advances the time by 2 per clock cycle. When None, it's the
+# shortest interval between the first 256 changes after the initial value, which always contain
+# a preamble with its intervals of 1 half time slot. The interval between the initial value and
+# the first change is the reset lead-in, which can be shorter than a half time slot.
+#
+# Yields arrays of levels. The last level is only known to last until the last change.
+def changes_to_half_slots(changes, half_slot_time = None):
+
+    last_time   = None
+    last_value  = 0
+
+    def shortest_interval(blocks):
+        intervals = np.diff(np.concatenate([ times for (times, values) in blocks ]))[1:]
+        intervals = intervals[intervals > 0]
+        return np.min(intervals) if len(intervals) else 1
+
+    def convert(times, values):
+        nonlocal last_time, last_value
+
+        if last_time is None:
+            (last_time, last_value) = (times[0], values[0])
+
+        durations   = np.diff(np.concatenate([ [ last_time ], times ]))
+        counts      = np.rint(durations / half_slot_time).astype(np.int64)
+        levels      = np.concatenate([ [ last_value ], values[:-1] ])
+
+        (last_time, last_value) = (times[-1], values[-1])
+
+        return np.repeat(levels, counts).astype(np.uint8)
+
+    pending = []
+    for (times, values) in changes:
+        if half_slot_time is not None:
+            yield convert(times, values)
+            continue
+
+        pending.append((times, values))
+        if sum(len(t) for (t, v) in pending) > 256:
+            half_slot_time = shortest_interval(pending)
+            for (t, v) in pending:
+                yield convert(t, v)
+            pending = []
+
+    # Streams that are too short for the estimate.
+    if pending:
+        half_slot_time = shortest_interval(pending)
+        for (t, v) in pending:
+            yield convert(t, v)
+
+# Decodes the S/PDIF output in a VCD file with constant memory use.
+#
+# Yields arrays of subframe_dtype, see SpdifDecoder. The positions are in half time slots
+# from the first change of the signal.
+def decode_vcd(filename, signal = "io_spdif", half_slot_time = None, nr_bits = 16, block_size = 1 << 24):
+
+    decoder = SpdifDecoder(nr_bits)
+
+    for half_slots in changes_to_half_slots(vcd_changes(filename, signal, block_size), half_slot_time):
+        subframes = decoder.decode(half_slots)
+        if len(subframes):
+            yield subframes